@@ -1,48 +1,160 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Download all IR spectra available from NIST Chemistry Webbook."""
+import argparse
+import functools
+import hashlib
+import itertools
+import json
 import os
+import random
 import re
+import sys
+import threading
 import time
-from collections import deque
-from datetime import datetime, timedelta
+from collections import Counter
 
-import requests
-from bs4 import BeautifulSoup
 from multiprocessing.pool import ThreadPool
 import tqdm
 
+from artifact_manifest import ArtifactManifest, MANIFEST_PATH
+from http_session import PooledSession
+from job_ledger import JobLedger, DONE, FAILED, NOT_FOUND
+from pack_store import PackStore, PACK_DIR
+from rate_limiter import AdaptiveTokenBucket, TokenBucket
+from scraper_metrics import Metrics
+from search_parser import extract_ids
+from scraper_events import CONNECTION, HTTP, OTHER, THROTTLED, TIMEOUT, classify, emit
+from species_parser import SPECIES_PATH, cas_to_nistid, load_species, lookup_ids, unique_formulae
 
-NIST_URL = 'http://webbook.nist.gov/cgi/cbook.cgi'
+
+# Point at a stand-in server (see nist_standin_server.py) with --base-url or the NIST_URL environment variable
+NIST_URL = os.environ.get('NIST_URL', 'http://webbook.nist.gov/cgi/cbook.cgi')
 EXACT_RE = re.compile('/cgi/cbook.cgi\?GetInChI=(.*?)$')
-ID_RE = re.compile('/cgi/cbook.cgi\?ID=(.*?)&')
+# Links to the other IR spectra of a compound on its IR spectrum page
+IR_INDEX_RE = re.compile('Type=IR-SPEC&(?:amp;)?Index=(\\d+)')
+ELEMENT_RE = re.compile('([A-Z][a-z]?)(\d*)')
 #NOTE: Change these
 JDX_PATH = 'jdx'
 MOL_PATH = 'mol'
+LEDGER_PATH = 'scraper_ledger.db'
+# Artifacts that a refresh found changed or removed, one JSON object per line
+REFRESH_REPORT_PATH = 'refresh_delta.jsonl'
+# What NIST returns instead of a missing spectrum or MOL file
+JDX_NOT_FOUND = '##TITLE=Spectrum not found.\n##END=\n'
+MOL_NOT_FOUND = 'NIST    12121112142D 1   1.00000     0.00000\nCopyright by the U.S. Sec. Commerce on behalf of U.S.A. All rights reserved.\n0  0  0     0  0              1 V2000\nM  END\n'
+# Complete downloads end with these lines; only the last TAIL_BYTES of a download are checked for them
+JDX_END = b'##END='
+MOL_END = b'M  END'
+TAIL_BYTES = 1024
+DOWNLOAD_CHUNK = 64 * 1024
+# How long NIST's "not found" answer for a spectrum or MOL file is trusted before asking again, in seconds
+NOT_FOUND_TTL = 30 * 24 * 3600
+# Sharded mode: where each worker saves its downloads, and how often (in seconds) it heartbeats the shard
+# it is working on. Well under the hour after which other workers reclaim a shard, whatever the request rate.
+SHARD_DIR = 'shards'
+HEARTBEAT_INTERVAL = 300
+# NIST cuts long result lists short, so a search returning this many IDs can't vouch for its superformulae
+SEARCH_RESULT_LIMIT = 400
+
+# Rate limiter - NIST allows 5 requests in a 30 second window, shared by all worker threads
+rate_limiter = TokenBucket(capacity=5, period=30)
+# Number of worker threads keeping searches and downloads in flight
+WORKERS = 8
+# Keep-alive connection pool shared by all workers
+POOL_SIZE = WORKERS
+RETRIES = 3
+# Resident mode: retries of a failed job before it is given up for this round, base backoff in seconds
+# by failure category (jittered and doubled per attempt), and rounds over all failed jobs before exiting
+TASK_RETRIES = 3
+RETRY_BACKOFF = {THROTTLED: 60.0, CONNECTION: 20.0, TIMEOUT: 10.0, HTTP: 10.0, OTHER: 5.0}
+RESIDENT_ROUNDS = 5
+RESIDENT_ROUND_DELAY = 300
+# Retries run_job makes itself, set from TASK_RETRIES in resident mode
+task_retries = 0
+session = PooledSession(pool_size=POOL_SIZE, retries=RETRIES)
+# Index of downloaded files, consulted instead of probing jdx/ and mol/ per ID. Opened by main() unless
+# downloads go to a pack store.
+manifest = None
+# Job ledger for the current run, set by get_all_IR
+ledger = None
+# Formula of each species fetched by CAS number, for falling back to a search (see retreive_data_from_cas)
+cas_formulae = {}
+# Element counts of completed, untruncated formula searches (see search_covered_by)
+searched_formulae = {}
+searched_lock = threading.Lock()
+# Optional pack file backend: when set, downloads are appended to pack files instead of jdx/ and mol/
+pack_store = None
+# Whether formula jobs fetch the IDs they find straight away. Sharded workers leave them to the ID phase,
+# where each is fetched by the worker owning its shard.
+fetch_search_results = True
+# Counters, histograms and gauges of the run, served or snapshotted with --metrics-port / --metrics-file
+metrics = Metrics()
+metrics.describe('scraper_rate_limit_wait_seconds', 'Time spent waiting for a rate limiter token')
+metrics.describe('scraper_http_seconds', 'Time spent in HTTP requests, by endpoint')
+metrics.describe('scraper_parse_seconds', 'Time spent parsing search result pages')
+metrics.describe('scraper_write_seconds', 'Time spent saving downloads')
+metrics.describe('scraper_artifacts_total', 'jdx and mol downloads by result: saved, exists or not_found')
+metrics.describe('scraper_not_found_cache_hits_total', 'Requests saved by the not-found cache')
+# Directory to keep formula search result pages in, e.g. for benchmark_search_parsing.py; None to not keep them
+search_pages_path = None
+# Progress of the phase being run, for the ETA gauges
+phase_progress = {'kind': None, 'total': 0, 'done': 0, 'started': 0.0}
+
+def acquire_token():
+    metrics.observe('scraper_rate_limit_wait_seconds', rate_limiter.acquire())
+
+def rate_budget_used():
+    """Fraction of the rate limiter's current window taken up by requests."""
+    return 1 - rate_limiter.available() / rate_limiter.capacity
+
+def run_budget_used():
+    """Fraction of the requests the rate limit allowed since the start of the run that were made."""
+    allowed = (time.time() - metrics.started) / rate_limiter.period * rate_limiter.capacity
+    return min(1.0, session.stats()['requests'] / allowed) if allowed else None
+
+def not_found_rate():
+    found = metrics.counter('scraper_artifacts_total', kind='jdx', result='saved') + metrics.counter('scraper_artifacts_total', kind='mol', result='saved')
+    missing = metrics.counter('scraper_artifacts_total', kind='jdx', result='not_found') + metrics.counter('scraper_artifacts_total', kind='mol', result='not_found')
+    return missing / (found + missing) if found + missing else None
 
-# Rate limiter - NIST allows 5 requests in a 30 second window
-request_timestamps = deque(maxlen=5)
-
-def rate_limited_request(*args, **kwargs):
-    """Wrapper for requests.get that respects NIST's rate limit of 5 requests per 30 seconds."""
-    current_time = datetime.now()
-    
-    # If we've made 5 requests already, check the oldest one
-    if len(request_timestamps) == 5:
-        oldest_request = request_timestamps[0]
-        time_since_oldest = (current_time - oldest_request).total_seconds()
-        
-        # If the oldest request was less than 30 seconds ago, wait
-        if time_since_oldest < 30:
-            sleep_time = 30 - time_since_oldest
-            time.sleep(sleep_time)
-    
-    # Make the request and record the timestamp
-    response = requests.get(*args, **kwargs)
-    request_timestamps.append(datetime.now())
-    
+def phase_eta():
+    """Seconds until the current phase is done at its rate so far."""
+    done, total = phase_progress['done'], phase_progress['total']
+    if not done:
+        return None
+    return (total - done) * (time.time() - phase_progress['started']) / done
+
+metrics.gauge('scraper_rate_budget_used', rate_budget_used)
+metrics.gauge('scraper_run_budget_used', run_budget_used)
+metrics.gauge('scraper_not_found_rate', not_found_rate)
+metrics.gauge('scraper_phase_jobs_remaining', lambda: phase_progress['total'] - phase_progress['done'] if phase_progress['kind'] else None)
+metrics.gauge('scraper_phase_eta_seconds', phase_eta)
+
+def adaptive_limiter_state(key):
+    """Gauge function for one field of the adaptive rate limiter's metrics(), None with a fixed rate limit."""
+    return lambda: rate_limiter.metrics()[key] if isinstance(rate_limiter, AdaptiveTokenBucket) else None
+
+for name, key in (('capacity', 'capacity'), ('rate_per_second', 'rate_per_second'), ('paused_seconds', 'paused_for'),
+                  ('increases', 'increases'), ('decreases', 'decreases'), ('window_error_rate', 'last_window_error_rate')):
+    metrics.gauge('scraper_adaptive_' + name, adaptive_limiter_state(key))
+
+def rate_limited_request(*args, endpoint = 'other', **kwargs):
+    """Wrapper for session.get that respects NIST's rate limit of 5 requests per 30 seconds."""
+    response = session.get(*args, acquire=acquire_token, release=rate_limiter.release, observe=getattr(rate_limiter, 'record', None), **kwargs)
+    # A streamed body is still to be received: the caller logs the request once it has been
+    if not kwargs.get('stream'):
+        log_request(response, endpoint)
     return response
 
+def log_request(response, endpoint):
+    """Count a response in the metrics and print its latency."""
+    timing = response.timing
+    metrics.observe('scraper_http_seconds', timing.total, endpoint=endpoint)
+    metrics.inc('scraper_http_responses_total', endpoint=endpoint, status=str(response.status_code))
+    print('HTTP %d in %.0f ms (connect %.0f ms%s, transfer %.0f ms)' % (response.status_code, timing.total * 1000,
+          timing.connect * 1000, ', reused' if timing.reused else '', timing.transfer * 1000))
+
 def search_nist_formula(formula, allow_other = False, allow_extra = False, match_isotopes = True, exclude_ions = False, has_ir = True):
     """Search NIST using the specified formula query and return the matching NIST IDs."""
     print('Searching: %s' % formula)
@@ -57,97 +169,709 @@ def search_nist_formula(formula, allow_other = False, allow_extra = False, match
         params['NoIon'] = 'on'
     if has_ir:
         params['cIR'] = 'on'
-    response = rate_limited_request(NIST_URL, params=params)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    ids = [re.match(ID_RE, link['href']).group(1) for link in soup('a', href = ID_RE)]
+    response = rate_limited_request(NIST_URL, params=params, endpoint='search')
+    if search_pages_path is not None:
+        with open(os.path.join(search_pages_path, '%s.html' % re.sub('[^A-Za-z0-9]', '_', formula)), 'w', encoding='utf-8') as page:
+            page.write(response.text)
+    with metrics.time('scraper_parse_seconds'):
+        ids = extract_ids(response.text)
     print('Result: %s' % ids)
     return ids
 
 
-def get_jdx(nistid, stype = "IR"):
-    """Download jdx file for the specified NIST ID, unless already downloaded."""
-    filepath = os.path.join(JDX_PATH, '%s-%s.jdx' % (nistid, stype))
-    if os.path.isfile(filepath):
+def have_artifact(nistid, stype, index = 0):
+    """Return True if the jdx (stype) or mol ('mol') file for an ID has already been saved."""
+    if pack_store is not None:
+        return pack_store.has(nistid, stype, index)
+    return manifest.has(nistid, stype, index)
+
+
+def end_marker(stype):
+    """The line a complete jdx (stype) or mol ('mol') file ends with."""
+    return MOL_END if stype == 'mol' else JDX_END
+
+
+def check_complete(nistid, stype, tail):
+    """Raise IOError unless the last bytes of a download contain the end marker of its file type."""
+    if end_marker(stype) not in tail:
+        raise IOError('%s %s: Truncated download, no %r at the end' % (nistid, stype, end_marker(stype).decode()))
+
+
+def write_atomic(nistid, stype, filepath, chunks):
+    """Write chunks to a temporary file next to filepath, check it is complete, fsync it and rename it
+    into place, so a crash never leaves a partial file behind. Return (size, SHA-256 digest)."""
+    partpath = '%s.%d.part' % (filepath, threading.get_ident())
+    digest = hashlib.sha256()
+    size = 0
+    tail = b''
+    try:
+        with open(partpath, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+                tail = (tail + chunk)[-TAIL_BYTES:]
+            check_complete(nistid, stype, tail)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(partpath, filepath)
+    except BaseException:
+        if os.path.exists(partpath):
+            os.remove(partpath)
+        raise
+    return size, digest.hexdigest()
+
+
+def store_artifact(nistid, stype, filepath, chunks, index = 0, response = None):
+    """Save a download, given as an iterable of byte chunks, to filepath or into the pack store if one
+    is in use. It only counts as saved once it is complete. Return (size, SHA-256 digest).
+
+    When the chunks are the body of a streamed response, the time spent receiving them is left out
+    of scraper_write_seconds, as it is already counted in the response's timing.
+    """
+    store = 'pack' if pack_store is not None else 'files'
+    received = response.timing.transfer if response is not None else 0.0
+    start = time.perf_counter()
+    try:
+        if pack_store is not None:
+            print('Saving %s %s to %s' % (nistid, stype, pack_store.root))
+            data = b''.join(chunks)
+            check_complete(nistid, stype, data[-TAIL_BYTES:])
+            return len(data), pack_store.put(nistid, stype, data, index)
+        print('Saving %s' % filepath)
+        size, digest = write_atomic(nistid, stype, filepath, chunks)
+        manifest.record(nistid, stype, filepath, idx=index, sha256=digest)
+        return size, digest
+    finally:
+        receiving = response.timing.transfer - received if response is not None else 0.0
+        metrics.observe('scraper_write_seconds', time.perf_counter() - start - receiving, store=store)
+
+
+def save_artifact(nistid, stype, filepath, data, index = 0):
+    """Save a downloaded file to filepath, or into the pack store if one is in use."""
+    store_artifact(nistid, stype, filepath, [data], index)
+
+
+def download_artifact(nistid, stype, index, params, endpoint, sentinel):
+    """Stream an artifact from NIST straight into the store.
+
+    Only the first bytes are read to compare against NIST's "not found" sentinel. Return the number
+    of bytes saved, or None if NIST answered with the sentinel.
+    """
+    response = rate_limited_request(NIST_URL, params=params, endpoint=endpoint, stream=True)
+    try:
+        with response:
+            response.raise_for_status()
+            chunks = session.iter_body(response, DOWNLOAD_CHUNK)
+            sentinel = sentinel.encode()
+            head = b''
+            for chunk in chunks:
+                head += chunk
+                if len(head) > len(sentinel):
+                    break
+            if head == sentinel:
+                return None
+            size, digest = store_artifact(nistid, stype, artifact_path(nistid, stype, index), itertools.chain([head], chunks), index, response)
+    finally:
+        log_request(response, endpoint)
+    record_validators(nistid, stype, index, response, digest)
+    return size
+
+
+def stored_sha256(nistid, stype, index = 0):
+    """Return the SHA-256 of the saved copy of an artifact, or None if there isn't one."""
+    if pack_store is not None:
+        return pack_store.digest(nistid, stype, index)
+    artifact = manifest.get(nistid, stype, index)
+    return artifact.sha256 if artifact is not None else None
+
+
+def record_validators(nistid, stype, index, response, digest):
+    """Keep the ETag, Last-Modified and content hash of a download, for conditional refreshes later."""
+    if ledger is not None:
+        ledger.record_validators(nistid, stype, index, response.headers.get('ETag'), response.headers.get('Last-Modified'), digest)
+
+
+def jdx_filename(nistid, stype = "IR", index = 0):
+    """The first spectrum of a type is saved as <ID>-<type>.jdx, any others as <ID>-<type>-<index>.jdx."""
+    if index == 0:
+        return '%s-%s.jdx' % (nistid, stype)
+    return '%s-%s-%d.jdx' % (nistid, stype, index)
+
+
+def artifact_path(nistid, stype, index = 0):
+    """Path of the jdx (stype) or mol ('mol') file for an ID in the file store."""
+    if stype == 'mol':
+        return os.path.join(MOL_PATH, '%s.mol' % nistid)
+    return os.path.join(JDX_PATH, jdx_filename(nistid, stype, index))
+
+
+def known_not_found(nistid, stype, index = 0):
+    """Return True if NIST reported an artifact missing within NOT_FOUND_TTL, saving a request."""
+    if ledger is None or not NOT_FOUND_TTL or not ledger.not_found(nistid, stype, index, NOT_FOUND_TTL):
+        return False
+    metrics.inc('scraper_not_found_cache_hits_total', kind='mol' if stype == 'mol' else 'jdx')
+    return True
+
+
+def remember_not_found(nistid, stype, index = 0):
+    if ledger is not None:
+        ledger.record_not_found(nistid, stype, index)
+
+
+def get_jdx(nistid, stype = "IR", index = 0):
+    """Download jdx file for the specified NIST ID and spectrum index, unless already downloaded.
+
+    Return the number of bytes saved (0 if it already existed), or None if NIST has no such spectrum.
+    """
+    filepath = artifact_path(nistid, stype, index)
+    if have_artifact(nistid, stype, index):
         print('%s %s: Already exists at %s' % (nistid, stype, filepath))
-        return
+        metrics.inc('scraper_artifacts_total', kind='jdx', result='exists')
+        return 0
+    if known_not_found(nistid, stype, index):
+        print('%s %s: Spectrum not found (cached)' % (nistid, stype))
+        return None
     print('%s %s: Downloading' % (nistid, stype))
-    response = rate_limited_request(NIST_URL, params={'JCAMP': nistid, 'Type': stype, 'Index': 0})
-    if response.text == '##TITLE=Spectrum not found.\n##END=\n':
+    saved = download_artifact(nistid, stype, index, {'JCAMP': nistid, 'Type': stype, 'Index': index}, 'jdx', JDX_NOT_FOUND)
+    if saved is None:
         print('%s %s: Spectrum not found' % (nistid, stype))
-        return
-    print('Saving %s' % filepath)
-    with open(filepath, 'wb') as file:
-        file.write(response.content)
+        metrics.inc('scraper_artifacts_total', kind='jdx', result='not_found')
+        remember_not_found(nistid, stype, index)
+        return None
+    metrics.inc('scraper_artifacts_total', kind='jdx', result='saved')
+    return saved
+
+
+def discover_ir_indices(nistid):
+    """Return the index of every IR spectrum NIST lists on the compound's IR spectrum page."""
+    print('%s: Discovering IR spectra' % nistid)
+    response = rate_limited_request(NIST_URL, params={'ID': nistid, 'Units': 'SI', 'Type': 'IR-SPEC', 'Index': 0}, endpoint='page')
+    indices = {0} | set(int(index) for index in IR_INDEX_RE.findall(response.text))
+    print('%s: IR spectrum indices %s' % (nistid, sorted(indices)))
+    return sorted(indices)
 
 
 def get_mol(nistid):
-    """Download mol file for the specified NIST ID, unless already downloaded."""
-    filepath = os.path.join(MOL_PATH, '%s.mol' % nistid)
-    if os.path.isfile(filepath):
+    """Download mol file for the specified NIST ID, unless already downloaded.
+
+    Return the number of bytes saved (0 if it already existed), or None if NIST has no MOL file.
+    """
+    filepath = artifact_path(nistid, 'mol')
+    if have_artifact(nistid, 'mol'):
         print('%s: Already exists at %s' % (nistid, filepath))
-        return
+        metrics.inc('scraper_artifacts_total', kind='mol', result='exists')
+        return 0
+    if known_not_found(nistid, 'mol'):
+        print('%s: MOL not found (cached)' % nistid)
+        return None
     print('%s: Downloading mol' % nistid)
-    response = rate_limited_request(NIST_URL, params={'Str2File': nistid})
-    if response.text == 'NIST    12121112142D 1   1.00000     0.00000\nCopyright by the U.S. Sec. Commerce on behalf of U.S.A. All rights reserved.\n0  0  0     0  0              1 V2000\nM  END\n':
+    saved = download_artifact(nistid, 'mol', 0, {'Str2File': nistid}, 'mol', MOL_NOT_FOUND)
+    if saved is None:
         print('%s: MOL not found' % nistid)
-        return
-    print('Saving %s' % filepath)
-    with open(filepath, 'wb') as file:
-        file.write(response.content)
+        metrics.inc('scraper_artifacts_total', kind='mol', result='not_found')
+        remember_not_found(nistid, 'mol')
+        return None
+    metrics.inc('scraper_artifacts_total', kind='mol', result='saved')
+    return saved
+
+def parse_formula(formula):
+    """Return a frozenset of (element, count) pairs for a neutral formula, or None if it can't be parsed."""
+    counts = {}
+    for element, count in ELEMENT_RE.findall(formula):
+        counts[element] = counts.get(element, 0) + int(count or 1)
+    if not counts or ''.join(element + count for element, count in ELEMENT_RE.findall(formula)) != formula:
+        return None
+    return frozenset(counts.items())
+
+def remember_search(formula, result_count):
+    """Note a completed search so it can cover later searches, unless its results may have been cut short."""
+    if result_count < SEARCH_RESULT_LIMIT:
+        elements = parse_formula(formula)
+        if elements is not None:
+            with searched_lock:
+                searched_formulae[elements] = formula
+
+def search_covered_by(formula):
+    """Return an already searched formula whose results include every result of searching this one, or None.
+
+    With AllowOther, a search matches every compound with exactly the given counts of the given elements
+    plus any others. So if F's element counts are a subset of G's, every result for G is also a result for F.
+    """
+    elements = parse_formula(formula)
+    if elements is None:
+        return None
+    with searched_lock:
+        for size in range(1, len(elements)):
+            for subset in itertools.combinations(elements, size):
+                covering = searched_formulae.get(frozenset(subset))
+                if covering is not None:
+                    return covering
+    return None
 
 def retreive_data_from_formula(formula):
+    """Download everything for a formula search and return the (ledger state, bytes saved)."""
+    covering = search_covered_by(formula)
+    if covering is not None:
+        print('Skipping %s: every result is covered by the %s search' % (formula, covering))
+        return DONE, 0
     ids = search_nist_formula(formula, allow_other = True, exclude_ions = False, has_ir = True)
-    for nistid in ids:
-        get_mol(nistid)
-        get_jdx(nistid)
+    ledger.record_search(formula, ids)
+    remember_search(formula, len(ids))
+    nbytes = 0
+    def fetch(nistid):
+        nonlocal nbytes
+        state, saved = retreive_data_from_id(nistid)
+        nbytes += saved
+        return state, saved
+    # IDs returned by several searches, or listed in species.txt, are only fetched once
+    if fetch_search_results:
+        for nistid in ids:
+            run_job('id', fetch, nistid)
+    return DONE, nbytes
+
+def retreive_data_from_id(nistid):
+    """Download the mol and jdx files for an ID and return the (ledger state, bytes saved)."""
+    mol_bytes = get_mol(nistid)
+    jdx_bytes = get_jdx(nistid)
+    state = NOT_FOUND if jdx_bytes is None else DONE
+    return state, (mol_bytes or 0) + (jdx_bytes or 0)
+
+def retreive_data_from_cas(cas):
+    """Fetch a species straight from its CAS-derived NIST ID and return the (ledger state, bytes saved).
+
+    Only if NIST has neither a MOL file nor an IR spectrum under that ID is the species' formula
+    queued for a search instead. If the ID job fails it has already been retried and reported, so
+    the CAS job is just marked failed rather than raising and being retried and reported again.
+    """
+    nistid = cas_to_nistid(cas)
+    if not run_job('id', retreive_data_from_id, nistid):
+        return FAILED, 0
+    if have_artifact(nistid, 'mol') or have_artifact(nistid, 'IR'):
+        return DONE, 0
+    formula = cas_formulae.get(cas)
+    if formula is not None:
+        print('%s: Nothing found under %s, falling back to a %s search' % (cas, nistid, formula))
+        ledger.add('formula', [formula])
+    return NOT_FOUND, 0
+
+def retreive_all_ir_spectra(nistid):
+    """Download every IR spectrum of an ID, discovering its indices once, and return the (ledger state, bytes saved)."""
+    indices = ledger.spectrum_indices(nistid, 'IR')
+    if not indices:
+        indices = discover_ir_indices(nistid)
+        ledger.record_spectrum_indices(nistid, 'IR', indices)
+    nbytes = 0
+    for index in indices:
+        nbytes += get_jdx(nistid, index = index) or 0
+    return DONE, nbytes
+
+def artifact_key(nistid, stype, index = 0):
+    """Ledger key of a refresh job for one artifact."""
+    return '%s|%s|%d' % (nistid, stype, index)
+
+def split_artifact_key(key):
+    nistid, stype, index = key.split('|')
+    return nistid, stype, int(index)
+
+report_lock = threading.Lock()
+refresh_changes = Counter()
+
+def report_change(nistid, stype, index, change, sha256 = None):
+    """Count a refresh outcome, and append changed or removed artifacts to the delta report."""
+    with report_lock:
+        refresh_changes[change] += 1
+        if change == 'unchanged':
+            return
+        with open(REFRESH_REPORT_PATH, 'a') as report:
+            report.write(json.dumps({'nistid': nistid, 'type': stype, 'idx': index, 'change': change,
+                                     'path': artifact_path(nistid, stype, index), 'sha256': sha256, 'time': time.time()}) + '\n')
+
+def refresh_artifact(key):
+    """Revalidate one saved artifact with a conditional request, rewriting it only if it changed.
+
+    Return the (ledger state, bytes saved).
+    """
+    nistid, stype, index = split_artifact_key(key)
+    validators = ledger.validators(nistid, stype, index)
+    headers = {}
+    if validators is not None and validators['etag']:
+        headers['If-None-Match'] = validators['etag']
+    if validators is not None and validators['last_modified']:
+        headers['If-Modified-Since'] = validators['last_modified']
+    if stype == 'mol':
+        params = {'Str2File': nistid}
+    else:
+        params = {'JCAMP': nistid, 'Type': stype, 'Index': index}
+    response = rate_limited_request(NIST_URL, params=params, headers=headers, endpoint='refresh')
+    if response.status_code == 304:
+        report_change(nistid, stype, index, 'unchanged')
+        return DONE, 0
+    response.raise_for_status()
+    if response.text in (JDX_NOT_FOUND, MOL_NOT_FOUND):
+        print('%s %s: No longer available from NIST' % (nistid, stype))
+        report_change(nistid, stype, index, 'removed')
+        return NOT_FOUND, 0
+    digest = hashlib.sha256(response.content).hexdigest()
+    known = validators['sha256'] if validators is not None and validators['sha256'] else stored_sha256(nistid, stype, index)
+    record_validators(nistid, stype, index, response, digest)
+    if digest == known:
+        report_change(nistid, stype, index, 'unchanged')
+        return DONE, 0
+    print('%s %s: Changed' % (nistid, stype))
+    save_artifact(nistid, stype, artifact_path(nistid, stype, index), response.content, index)
+    report_change(nistid, stype, index, 'changed', digest)
+    return DONE, len(response.content)
+
+def run_job(kind, task, key):
+    """Run one formula or ID job, unless it is finished or already claimed, recording its outcome in the ledger.
+
+    Return True if it didn't fail.
+    """
+    if not ledger.claim(kind, key):
+        return True
+    ledger.start(kind, key)
+    for attempt in range(task_retries + 1):
+        try:
+            state, nbytes = task(key)
+            break
+        except Exception as error:
+            category = classify(error)
+            if attempt < task_retries:
+                delay = RETRY_BACKOFF[category] * 2 ** attempt * random.uniform(0.5, 1.5)
+                print('%s %s: failed with %s: %s, retrying in %.0f s' % (kind, key, type(error).__name__, error, delay))
+                time.sleep(delay)
+                continue
+            print('%s %s: failed with %s: %s' % (kind, key, type(error).__name__, error))
+            ledger.finish(kind, key, FAILED, error='%s: %s' % (type(error).__name__, error))
+            emit('job-failed', kind=kind, key=key, category=category, error='%s: %s' % (type(error).__name__, error))
+            return False
+    ledger.finish(kind, key, state, nbytes)
+    return state != FAILED
 
-def get_all_IR():
-    """Search NIST for all structures with IR Spectra and download a JDX + Mol file for each."""
-    # Create directories if they don't exist
+def prepare_store():
+    """Create the jdx and mol directories. The first run indexes whatever is already on disk; after that
+    the manifest is updated as files land."""
     os.makedirs(JDX_PATH, exist_ok=True)
     os.makedirs(MOL_PATH, exist_ok=True)
-    
-    formulae = []
-    IDs = []
-    with open("species.txt") as data_file:
-        entries = data_file.readlines()
-        for entry in entries:
-            try:
-                formulae.append(entry.split()[-2])
-            except:
-                IDs.append(entry.strip())
-    
-    # Process formulas sequentially rather than in parallel to respect rate limits
-    print(f"Processing {len(formulae)} formulas...")
-    # load in a set of done formulae
-    # if already done, skip
-    # if not done, add to done list
-    done_formulae = set()
-    with open("done_formulae.txt", "r") as done_file:
-        done_formulae = set(line.strip() for line in done_file)
-    for formula in tqdm.tqdm(formulae, total=len(formulae)):
-        if formula in done_formulae:
-            continue
-        retreive_data_from_formula(formula)
-        with open("done_formulae.txt", "a") as done_file:
-            done_file.write(formula + "\n")
-    print("Done with formulas!")
-    
-    print(f"Processing {len(IDs)} IDs...")
-    # load in a set of done IDs
-    # if already done, skip
-    # if not done, add to done list
-    done_IDs = set()
-    with open("done_IDs.txt", "r") as done_file:
-        done_IDs = set(line.strip() for line in done_file)
-    for nistid in tqdm.tqdm(IDs, total=len(IDs)):
-        if nistid in done_IDs:
-            continue
-        get_mol(nistid)
-        get_jdx(nistid)
-        with open("done_IDs.txt", "a") as done_file:
-            done_file.write(nistid + "\n")
+    if pack_store is None and not len(manifest):
+        manifest.build(JDX_PATH, MOL_PATH)
+
+def register_jobs(species, cas_direct = False):
+    """Add a job to the ledger for every formula, CAS number and ID to fetch from species.txt."""
+    ledger.import_done_file('formula', 'done_formulae.txt')
+    ledger.import_done_file('id', 'done_IDs.txt')
+    if cas_direct:
+        ledger.add('cas', cas_formulae)
+        ledger.add('formula', unique_formulae(record for record in species if record.cas not in cas_formulae))
+        ledger.add('id', (record.nistid for record in species if record.nistid))
+    else:
+        ledger.add('formula', unique_formulae(species))
+        ledger.add('id', lookup_ids(species))
+
+def scrape_phases(all_indices = False, cas_direct = False):
+    """Return the (job kind, task) phases of a scrape, in the order they run."""
+    phases = [('formula', retreive_data_from_formula), ('id', retreive_data_from_id)]
+    if cas_direct:
+        phases.insert(0, ('cas', retreive_data_from_cas))
+    if all_indices:
+        phases.append(('ir-indices', retreive_all_ir_spectra))
+    return phases
+
+def start_phase(kind):
+    """Register jobs that only exist once the earlier phases are done."""
+    if kind == 'ir-indices':
+        ledger.add(kind, ledger.keys('id', DONE))
+
+def pending_jobs(kind, shard = None, shards = None):
+    pending = ledger.pending(kind, shard, shards)
+    if kind == 'formula':
+        # Search formulae with fewer elements first, so they can cover the searches for their superformulae
+        pending.sort(key=lambda formula: len(parse_formula(formula) or ()))
+    return pending
+
+def load_run_state(species, cas_direct = False):
+    """Load the in-memory state jobs rely on: CAS fallbacks and completed searches."""
+    if cas_direct:
+        cas_formulae.update((record.cas, record.formula) for record in species if cas_to_nistid(record.cas))
+    for formula, result_count in ledger.searches().items():
+        remember_search(formula, result_count)
+
+def get_all_IR(workers = WORKERS, all_indices = False, cas_direct = False, retry_failed = False, resident = False):
+    """Search NIST for all structures with IR Spectra and download a JDX + Mol file for each.
+
+    With all_indices, also download every other IR spectrum of each ID that has one. With cas_direct,
+    species with a CAS number are fetched by their CAS-derived ID, and only searched for by formula
+    if that finds nothing. With retry_failed, only rerun the jobs that failed in an earlier run.
+    With resident, keep rerunning failed jobs in this process for up to RESIDENT_ROUNDS rounds.
+    """
+    global ledger
+    prepare_store()
+    species = load_species(SPECIES_PATH)
+    ledger = JobLedger(LEDGER_PATH)
+    load_run_state(species, cas_direct)
+    if not retry_failed:
+        register_jobs(species, cas_direct)
+    failures = 0
+    # Workers run searches and downloads concurrently, all drawing from the shared rate limiter.
+    # Job outcomes are batched into the ledger, and a resumed run only picks up unfinished jobs.
+    try:
+        with ThreadPool(workers) as pool:
+            for kind, task in scrape_phases(all_indices, cas_direct):
+                if retry_failed:
+                    failures += run_phase(pool, kind, task, ledger.keys(kind, FAILED))
+                    continue
+                start_phase(kind)
+                failures += run_phase(pool, kind, task, pending_jobs(kind))
+            # Species, searches, the ledger and the connection pool stay loaded between rounds
+            for rerun in range(RESIDENT_ROUNDS if resident else 0):
+                if not failures:
+                    break
+                delay = RESIDENT_ROUND_DELAY * random.uniform(0.5, 1.5)
+                print('%d jobs failed, retrying them in %.0f s (round %d/%d)' % (failures, delay, rerun + 1, RESIDENT_ROUNDS))
+                time.sleep(delay)
+                failures = sum(run_phase(pool, kind, task, ledger.keys(kind, FAILED)) for kind, task in scrape_phases(all_indices, cas_direct))
+    finally:
+        ledger.close()
     print("Done Scraping Data!")
+    print_session_stats()
+    return failures
+
+def coordinate_shards(shards, budget = 5, worker_count = 1, all_indices = False, cas_direct = False):
+    """Set up a sharded scrape in the shared ledger, for workers on several machines or egress IPs to claim.
+
+    Every job is assigned to one of `shards` shards by a hash of its key. budget is the total number of
+    requests per 30 s all worker_count workers may make together; each worker gets an equal share.
+    """
+    global ledger
+    species = load_species(SPECIES_PATH)
+    ledger = JobLedger(LEDGER_PATH, wal=False)
+    try:
+        load_run_state(species, cas_direct)
+        register_jobs(species, cas_direct)
+        for kind, task in scrape_phases(all_indices, cas_direct):
+            ledger.create_shards(kind, shards)
+        for key, value in (('shards', shards), ('budget', budget), ('worker_count', worker_count),
+                           ('all_indices', int(all_indices)), ('cas_direct', int(cas_direct))):
+            ledger.set_meta(key, value)
+    finally:
+        ledger.close()
+    print('Ledger %s split into %d shards for %d workers, %d requests per 30 s each' % (LEDGER_PATH, shards, worker_count,
+          max(1, budget // worker_count)))
+
+def keep_shard_alive(kind, shard, name, stop):
+    """Heartbeat a claimed shard every HEARTBEAT_INTERVAL seconds until stop is set."""
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        ledger.heartbeat(kind, shard, name)
+
+def run_shard_worker(name, workers = WORKERS, poll_interval = 60):
+    """Claim shards of the scrape set up by coordinate_shards until every phase is done.
+
+    A phase only starts once all of its predecessor's shards are finished, so every ID found by a
+    search is fetched exactly once, by the worker owning its shard. Return the number of failed jobs.
+    """
+    global ledger, fetch_search_results
+    prepare_store()
+    ledger = JobLedger(LEDGER_PATH, wal=False)
+    shards = int(ledger.get_meta('shards'))
+    rate_limiter.capacity = max(1, int(ledger.get_meta('budget')) // int(ledger.get_meta('worker_count')))
+    if isinstance(rate_limiter, AdaptiveTokenBucket):
+        # Backing off is fine, but no worker may grow past its share of the budget
+        rate_limiter.max_capacity = rate_limiter.capacity
+    all_indices, cas_direct = ledger.get_meta('all_indices') == '1', ledger.get_meta('cas_direct') == '1'
+    fetch_search_results = False
+    load_run_state(load_species(SPECIES_PATH), cas_direct)
+    print('Worker %s: %d shards, %d requests per 30 s' % (name, shards, rate_limiter.capacity))
+    failures = 0
+    try:
+        with ThreadPool(workers) as pool:
+            for kind, task in scrape_phases(all_indices, cas_direct):
+                start_phase(kind)
+                while True:
+                    shard = ledger.claim_shard(kind, name)
+                    if shard is None:
+                        if ledger.phase_done(kind):
+                            break
+                        # Other workers are still finishing this phase, or may have died and left a shard to reclaim
+                        time.sleep(poll_interval)
+                        continue
+                    print('Worker %s: %s shard %d' % (name, kind, shard))
+                    stop = threading.Event()
+                    heartbeat = threading.Thread(target=keep_shard_alive, args=(kind, shard, name, stop), daemon=True)
+                    heartbeat.start()
+                    try:
+                        shard_failures = run_phase(pool, kind, task, pending_jobs(kind, shard, shards))
+                    finally:
+                        stop.set()
+                        heartbeat.join()
+                    ledger.finish_shard(kind, shard, failed = shard_failures > 0)
+                    failures += shard_failures
+    finally:
+        ledger.close()
+    print_session_stats()
+    return failures
+
+def merge_shards(shard_dir = SHARD_DIR):
+    """Move every sharded worker's downloads into the main jdx/ and mol/ tree (or pack store)."""
+    prepare_store()
+    if not os.path.isdir(shard_dir):
+        print('No sharded downloads in %s' % shard_dir)
+        return
+    merged = 0
+    for name in sorted(os.listdir(shard_dir)):
+        root = os.path.join(shard_dir, name)
+        worker_manifest_path = os.path.join(root, MANIFEST_PATH)
+        if os.path.isfile(worker_manifest_path):
+            worker_manifest = ArtifactManifest(worker_manifest_path)
+            for artifact in worker_manifest.artifacts():
+                if not have_artifact(artifact.nistid, artifact.type, artifact.idx):
+                    with open(artifact.path, 'rb') as file:
+                        save_artifact(artifact.nistid, artifact.type, artifact_path(artifact.nistid, artifact.type, artifact.idx), file.read(), artifact.idx)
+                    merged += 1
+            worker_manifest.close()
+        worker_packs = os.path.join(root, PACK_DIR)
+        if os.path.isdir(worker_packs):
+            worker_store = PackStore(worker_packs)
+            for nistid, stype, index in worker_store.keys():
+                if not have_artifact(nistid, stype, index):
+                    save_artifact(nistid, stype, artifact_path(nistid, stype, index), worker_store.get(nistid, stype, index), index)
+                    merged += 1
+            worker_store.close()
+    print('Merged %d artifacts from %s' % (merged, shard_dir))
+
+def run_phase(pool, kind, task, pending):
+    """Run the pending jobs of one kind on the worker pool and return how many failed."""
+    print(f"Processing {len(pending)} {kind} jobs...")
+    failures = 0
+    job = functools.partial(run_job, kind, task)
+    phase_progress.update(kind=kind, total=len(pending), done=0, started=time.time())
+    for ok in tqdm.tqdm(pool.imap_unordered(job, pending), total=len(pending)):
+        failures += not ok
+        phase_progress['done'] += 1
+    counts = ledger.counts(kind)
+    print(f"Done with {kind} jobs: {counts}")
+    emit('phase-done', kind=kind, failures=failures, counts=counts)
+    return failures
+
+def refresh_mirror(workers = WORKERS):
+    """Revalidate every saved jdx and mol file against NIST, rewriting only the ones that changed.
+
+    Changed and removed artifacts are appended to REFRESH_REPORT_PATH for incremental preprocessing.
+    """
+    global ledger
+    if pack_store is not None:
+        keys = [artifact_key(*key) for key in pack_store.keys()]
+    else:
+        keys = [artifact_key(*artifact[:3]) for artifact in manifest.artifacts()]
+    ledger = JobLedger(LEDGER_PATH)
+    # Start a new refresh round once the previous one is complete, otherwise resume it
+    if not ledger.pending('refresh'):
+        ledger.reset('refresh')
+    ledger.add('refresh', keys)
+    try:
+        with ThreadPool(workers) as pool:
+            failures = run_phase(pool, 'refresh', refresh_artifact, ledger.pending('refresh'))
+    finally:
+        ledger.close()
+    print('Refresh done: %s, delta report in %s' % (dict(refresh_changes), REFRESH_REPORT_PATH))
+    print_session_stats()
+    return failures
+
+def print_session_stats():
+    stats = session.stats()
+    if stats['requests']:
+        print('%d requests over %d connections: mean connect %.0f ms, mean transfer %.0f ms' % (stats['requests'],
+              stats['connections'], stats['connect'] / stats['requests'] * 1000, stats['transfer'] / stats['requests'] * 1000))
+    saved = metrics.counter('scraper_not_found_cache_hits_total', kind='jdx') + metrics.counter('scraper_not_found_cache_hits_total', kind='mol')
+    if saved:
+        print('Not-found cache saved %d requests' % saved)
+    print('Time spent waiting for the rate limit %.0f s, in HTTP %.0f s, parsing %.0f s, writing %.0f s' % (
+          metrics.total('scraper_rate_limit_wait_seconds'), metrics.total('scraper_http_seconds'),
+          metrics.total('scraper_parse_seconds'), metrics.total('scraper_write_seconds')))
+    if isinstance(rate_limiter, AdaptiveTokenBucket):
+        print('Adaptive rate limiter: %s' % rate_limiter.metrics())
+
+def main():
+    global NIST_URL, NOT_FOUND_TTL, session, search_pages_path, pack_store, rate_limiter, manifest, task_retries, JDX_PATH, MOL_PATH, LEDGER_PATH
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='number of concurrent worker threads')
+    parser.add_argument('--pool-size', type=int, default=None, help='keep-alive connections to keep open (default: one per worker)')
+    parser.add_argument('--retries', type=int, default=RETRIES, help='retries per request on connection errors and 429/5xx responses')
+    parser.add_argument('--adaptive', action='store_true', help='adapt the request rate to 429/5xx responses instead of a fixed 5 per 30 s')
+    parser.add_argument('--max-rate', type=int, default=20, help='most requests per 30 s the adaptive limiter may reach')
+    parser.add_argument('--store', choices=('files', 'pack'), default='files', help='save downloads as files in jdx/ and mol/, or into pack files')
+    parser.add_argument('--pack-dir', default=PACK_DIR, help='pack store directory for --store pack')
+    parser.add_argument('--all-indices', action='store_true', help='download every IR spectrum of each compound, not just index 0')
+    parser.add_argument('--cas-direct', action='store_true', help='fetch species by their CAS number, searching by formula only as a fallback')
+    parser.add_argument('--refresh', action='store_true', help='revalidate saved files with conditional requests instead of scraping')
+    parser.add_argument('--resident', action='store_true', help='retry failed jobs with jittered backoff in this process instead of exiting')
+    parser.add_argument('--retry-failed', action='store_true', help='only rerun the jobs that failed in an earlier run')
+    parser.add_argument('--base-url', default=NIST_URL, help='NIST cbook.cgi URL, e.g. of a local nist_standin_server.py')
+    parser.add_argument('--save-search-pages', metavar='DIR', help='keep every formula search result page in DIR')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-file', help='write a JSON metrics snapshot to this file every --metrics-interval seconds')
+    parser.add_argument('--metrics-interval', type=float, default=30, help='seconds between metrics snapshots')
+    parser.add_argument('--not-found-ttl', type=float, default=NOT_FOUND_TTL / 86400, help='days to trust a "not found" answer before asking NIST again, 0 to always ask')
+    parser.add_argument('--ledger', default=LEDGER_PATH, help='job ledger database, shared by all workers in sharded mode')
+    parser.add_argument('--coordinate', type=int, metavar='SHARDS', help='split the scrape into SHARDS shards for sharded workers, then exit')
+    parser.add_argument('--budget', type=int, default=5, help='with --coordinate: requests per 30 s shared by all sharded workers')
+    parser.add_argument('--worker-count', type=int, default=1, help='with --coordinate: number of sharded workers splitting the budget')
+    parser.add_argument('--worker', metavar='NAME', help='run as a sharded worker, claiming shards from the ledger')
+    parser.add_argument('--shard-dir', default=SHARD_DIR, help='where sharded workers save their downloads, one directory each')
+    parser.add_argument('--merge', action='store_true', help='merge the sharded workers\' downloads into the main tree, then exit')
+    args = parser.parse_args()
+    LEDGER_PATH = args.ledger
+    NIST_URL = args.base_url
+    NOT_FOUND_TTL = args.not_found_ttl * 86400
+    if args.coordinate:
+        coordinate_shards(args.coordinate, args.budget, args.worker_count, args.all_indices, args.cas_direct)
+        return
+    manifest_path = MANIFEST_PATH
+    if args.worker:
+        root = os.path.join(args.shard_dir, args.worker)
+        os.makedirs(root, exist_ok=True)
+        JDX_PATH, MOL_PATH = os.path.join(root, JDX_PATH), os.path.join(root, MOL_PATH)
+        manifest_path = os.path.join(root, MANIFEST_PATH)
+        args.pack_dir = os.path.join(root, args.pack_dir)
+    if args.resident:
+        task_retries = TASK_RETRIES
+    if args.save_search_pages:
+        os.makedirs(args.save_search_pages, exist_ok=True)
+        search_pages_path = args.save_search_pages
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics.write_snapshots(args.metrics_file, args.metrics_interval)
+    emit('run-start', pid=os.getpid(), argv=sys.argv[1:])
+    session = PooledSession(pool_size=args.pool_size or args.workers, retries=args.retries)
+    if args.adaptive:
+        rate_limiter = AdaptiveTokenBucket(capacity=5, period=30, max_capacity=args.max_rate)
+    if args.store == 'pack':
+        pack_store = PackStore(args.pack_dir)
+    else:
+        manifest = ArtifactManifest(manifest_path)
+    try:
+        if args.merge:
+            merge_shards(args.shard_dir)
+            failures = 0
+        elif args.worker:
+            failures = run_shard_worker(args.worker, workers=args.workers)
+        elif args.refresh:
+            failures = refresh_mirror(workers=args.workers)
+        else:
+            failures = get_all_IR(workers=args.workers, all_indices=args.all_indices, cas_direct=args.cas_direct,
+                                  retry_failed=args.retry_failed, resident=args.resident)
+    finally:
+        if pack_store is not None:
+            pack_store.close()
+        if manifest is not None:
+            manifest.close()
+    if args.metrics_file:
+        metrics.write_snapshot(args.metrics_file)
+    emit('run-done', failures=failures)
+    if failures:
+        print('%d jobs failed and will be retried on the next run' % failures)
+        sys.exit(1)
 
 if __name__ == '__main__':
-    get_all_IR()
+    main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Manifest of every downloaded jdx/mol artifact, so nothing has to stat or list jdx/ and mol/."""
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+
+MANIFEST_PATH = 'artifacts.db'
+# jdx files are named <NIST ID>-<spectrum type>.jdx, or <NIST ID>-<spectrum type>-<index>.jdx for
+# every spectrum after the first, and mol files <NIST ID>.mol
+JDX_NAME_RE = re.compile(r'^(.*)-([A-Za-z]+)(?:-(\d+))?\.jdx$')
+MOL_NAME_RE = re.compile(r'^(.*)\.mol$')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    nistid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    idx INTEGER NOT NULL DEFAULT 0,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (nistid, type, idx)
+);
+"""
+
+# type is 'mol' for MOL files and the spectrum type (e.g. 'IR') for jdx files
+Artifact = namedtuple('Artifact', ['nistid', 'type', 'idx', 'path', 'size', 'mtime', 'sha256'])
+
+
+def parse_filename(filename):
+    """Return (nistid, type, idx) for a jdx or mol filename, or None if it isn't one."""
+    match = JDX_NAME_RE.match(filename)
+    if match:
+        return match.group(1), match.group(2), int(match.group(3) or 0)
+    match = MOL_NAME_RE.match(filename)
+    if match:
+        return match.group(1), 'mol', 0
+    return None
+
+
+def file_sha256(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+class ArtifactManifest:
+    """SQLite-backed manifest of downloaded artifacts, held in memory for O(1) lookups."""
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._entries = {}
+        for row in self.conn.execute('SELECT * FROM artifacts'):
+            artifact = Artifact(*row)
+            self._entries[artifact[:3]] = artifact
+
+    def __len__(self):
+        return len(self._entries)
+
+    def has(self, nistid, stype, idx=0):
+        return (nistid, stype, idx) in self._entries
+
+    def get(self, nistid, stype, idx=0):
+        """Return the Artifact for an ID, or None if it hasn't been downloaded."""
+        return self._entries.get((nistid, stype, idx))
+
+    def artifacts(self, stype=None):
+        """Return all artifacts, or those of one type, sorted by NIST ID."""
+        return sorted(artifact for artifact in self._entries.values() if stype is None or artifact.type == stype)
+
+    def record(self, nistid, stype, path, data=None, idx=0, sha256=None):
+        """Add or update the entry for a file that has just been written. data is its content, or sha256 its digest, if at hand."""
+        stat = os.stat(path)
+        if sha256 is not None:
+            digest = sha256
+        else:
+            digest = hashlib.sha256(data).hexdigest() if data is not None else file_sha256(path)
+        artifact = Artifact(nistid, stype, idx, path, stat.st_size, stat.st_mtime, digest)
+        with self._lock:
+            self._entries[artifact[:3]] = artifact
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)', artifact)
+        return artifact
+
+    def build(self, jdx_path='jdx', mol_path='mol'):
+        """Index every file in the jdx and mol directories in one listing each, dropping entries whose file is gone."""
+        found = {}
+        for directory in (jdx_path, mol_path):
+            if not os.path.isdir(directory):
+                continue
+            for entry in os.scandir(directory):
+                key = parse_filename(entry.name)
+                if key is None or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                known = self._entries.get(key)
+                if known is not None and known.path == entry.path and known.size == stat.st_size and known.mtime == stat.st_mtime:
+                    found[key] = known
+                else:
+                    found[key] = Artifact(*key, entry.path, stat.st_size, stat.st_mtime, file_sha256(entry.path))
+        with self._lock:
+            self._entries = found
+            with self.conn:
+                self.conn.execute('DELETE FROM artifacts')
+                self.conn.executemany('INSERT INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?)', found.values())
+        print('Manifest %s: %d artifacts' % (self.path, len(found)))
+
+    def close(self):
+        self.conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild the artifact manifest from the jdx and mol directories.')
+    parser.add_argument('--manifest', default=MANIFEST_PATH)
+    parser.add_argument('--jdx', default='jdx')
+    parser.add_argument('--mol', default='mol')
+    args = parser.parse_args()
+    manifest = ArtifactManifest(args.manifest)
+    manifest.build(args.jdx, args.mol)
+    manifest.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark the regex link extractor against BeautifulSoup on saved formula search result pages.
+
+Save pages with `"1) NIST Spectra Scraper.py" --save-search-pages search_pages`, then run this
+script on that directory.
+"""
+import argparse
+import os
+import time
+
+from search_parser import extract_ids_fast, extract_ids_soup
+
+
+def best_time(function, page, repeat):
+    """Return the fastest of `repeat` timings of function(page), in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(page)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('pages', nargs='?', default='search_pages', help='directory of saved result pages')
+    parser.add_argument('--repeat', type=int, default=5, help='timings per page and parser; the fastest is kept')
+    args = parser.parse_args()
+    paths = sorted(os.path.join(args.pages, name) for name in os.listdir(args.pages) if name.endswith('.html'))
+    total_fast = total_soup = 0.0
+    mismatches = 0
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as page_file:
+            page = page_file.read()
+        if extract_ids_fast(page) != extract_ids_soup(page):
+            mismatches += 1
+            print('%s: the parsers disagree' % path)
+        fast = best_time(extract_ids_fast, page, args.repeat)
+        soup = best_time(extract_ids_soup, page, args.repeat)
+        total_fast += fast
+        total_soup += soup
+        print('%s: %d bytes, regex %.3f ms, BeautifulSoup %.3f ms, %.0fx' % (os.path.basename(path), len(page),
+              fast * 1000, soup * 1000, soup / fast if fast else float('inf')))
+    if paths:
+        print('%d pages: regex %.3f ms/page, BeautifulSoup %.3f ms/page, %.0fx speedup, %d mismatches' % (len(paths),
+              total_fast / len(paths) * 1000, total_soup / len(paths) * 1000, total_soup / total_fast if total_fast else float('inf'), mismatches))
+
+
+if __name__ == '__main__':
+    main()
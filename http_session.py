@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Pooled keep-alive HTTP session used for every NIST scraper request."""
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from rate_limiter import retry_after_seconds
+
+
+# Status codes worth retrying - throttling and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Latency of a single request: time spent opening a connection (0 when a pooled one was reused)
+# and time spent sending the request and receiving the response
+RequestTiming = namedtuple('RequestTiming', ['connect', 'transfer', 'total', 'reused'])
+
+_connect_time = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_time.value = getattr(_connect_time, 'value', 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        _connect_time.value = getattr(_connect_time, 'value', 0.0) + time.perf_counter() - start
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled connections record how long they take to connect."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+
+
+class PooledSession:
+    """requests.Session wrapper with keep-alive connection pooling, retries and latency accounting."""
+
+    def __init__(self, pool_size=10, retries=3, backoff=2.0, timeout=60):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
+        self._lock = threading.Lock()
+        self._totals = {'requests': 0, 'connections': 0, 'connect': 0.0, 'transfer': 0.0}
+
+    def get(self, url, acquire=None, release=None, observe=None, **kwargs):
+        """GET url, retrying transient failures with exponential backoff, or as long as Retry-After asks.
+
+        acquire is called before every attempt, so retries are drawn from the rate limit too, release
+        once the attempt has completed or failed, and observe(status, retry_after) after it, with a
+        status of None for a connection error.
+        The returned response carries a RequestTiming as response.timing.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        for attempt in range(self.retries + 1):
+            if acquire is not None:
+                acquire()
+            retry_after = None
+            try:
+                try:
+                    response = self._timed_get(url, **kwargs)
+                finally:
+                    if release is not None:
+                        release()
+            except (requests.ConnectionError, requests.Timeout):
+                if observe is not None:
+                    observe(None)
+                if attempt == self.retries:
+                    raise
+            else:
+                retry_after = response.headers.get('Retry-After')
+                if observe is not None:
+                    observe(response.status_code, retry_after)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                # Release the connection of a streamed response, or it never goes back to the pool
+                response.close()
+            time.sleep(max(self.backoff * 2 ** attempt, retry_after_seconds(retry_after) or 0))
+
+    def _timed_get(self, url, **kwargs):
+        _connect_time.value = 0.0
+        start = time.perf_counter()
+        response = self.session.get(url, **kwargs)
+        total = time.perf_counter() - start
+        connect = _connect_time.value
+        response.timing = RequestTiming(connect, total - connect, total, connect == 0.0)
+        with self._lock:
+            self._totals['requests'] += 1
+            self._totals['connections'] += not response.timing.reused
+            self._totals['connect'] += connect
+            self._totals['transfer'] += total - connect
+        return response
+
+    def iter_body(self, response, chunk_size):
+        """Iterate over the body of a streamed response, adding the time spent receiving it to
+        response.timing and the totals, which otherwise stop when the headers arrive."""
+        body = response.iter_content(chunk_size)
+        while True:
+            start = time.perf_counter()
+            chunk = next(body, None)
+            elapsed = time.perf_counter() - start
+            response.timing = response.timing._replace(transfer=response.timing.transfer + elapsed, total=response.timing.total + elapsed)
+            with self._lock:
+                self._totals['transfer'] += elapsed
+            if chunk is None:
+                return
+            yield chunk
+
+    def stats(self):
+        """Return request, new connection and cumulative connect/transfer time totals."""
+        with self._lock:
+            return dict(self._totals)
+
+    def close(self):
+        self.session.close()
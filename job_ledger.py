@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Transactional SQLite ledger of scraper jobs (formula searches and NIST ID downloads)."""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+PENDING = 'pending'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+NOT_FOUND = 'not-found'
+FAILED = 'failed'
+# States a resumed run still has to work through
+UNFINISHED = (PENDING, IN_FLIGHT, FAILED)
+# States of a shard in sharded mode
+CLAIMED = 'claimed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_state ON jobs (kind, state);
+CREATE TABLE IF NOT EXISTS searches (
+    formula TEXT PRIMARY KEY,
+    result_count INTEGER NOT NULL,
+    searched_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS search_results (
+    formula TEXT NOT NULL,
+    nistid TEXT NOT NULL,
+    PRIMARY KEY (formula, nistid)
+);
+CREATE INDEX IF NOT EXISTS search_results_by_id ON search_results (nistid);
+CREATE TABLE IF NOT EXISTS spectrum_indices (
+    nistid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    discovered_at REAL NOT NULL,
+    PRIMARY KEY (nistid, type, idx)
+);
+CREATE TABLE IF NOT EXISTS validators (
+    nistid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    sha256 TEXT,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (nistid, type, idx)
+);
+CREATE TABLE IF NOT EXISTS not_found (
+    nistid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    checked_at REAL NOT NULL,
+    PRIMARY KEY (nistid, type, idx)
+);
+CREATE TABLE IF NOT EXISTS shards (
+    phase TEXT NOT NULL,
+    shard INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    heartbeat REAL,
+    PRIMARY KEY (phase, shard)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def shard_of(key, shards):
+    """Deterministically assign a job key to one of `shards` shards."""
+    return int(hashlib.sha1(key.encode('utf-8')).hexdigest()[:8], 16) % shards
+
+
+class JobLedger:
+    """Per-job state, attempt count, byte count and timestamps, kept in SQLite (WAL mode).
+
+    Updates from worker threads are queued and committed in batches of `batch_size`, or at
+    least every `flush_interval` seconds, instead of one file append per job.
+    """
+
+    def __init__(self, path='scraper_ledger.db', batch_size=100, flush_interval=5.0, wal=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.create_function('shard_of', 2, shard_of, deterministic=True)
+        # WAL needs shared memory, so a ledger shared by workers on several machines uses a rollback journal
+        self.conn.execute('PRAGMA journal_mode=%s' % ('WAL' if wal else 'DELETE'))
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._queue = []
+        self._last_flush = time.monotonic()
+        # Jobs claimed by this process, so an ID found by several searches is only fetched once
+        self._claimed = set()
+
+    def _transaction(self, statements):
+        """Run (sql, params) statements in a single transaction."""
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, params in statements:
+                    self.conn.execute(sql, params)
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def _enqueue(self, sql, params):
+        with self._lock:
+            self._queue.append((sql, params))
+            if len(self._queue) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        """Commit every queued update."""
+        with self._lock:
+            queue, self._queue = self._queue, []
+            self._last_flush = time.monotonic()
+            if queue:
+                self._transaction(queue)
+
+    def add(self, kind, keys):
+        """Register jobs as pending, leaving any that are already known untouched."""
+        now = time.time()
+        with self._lock:
+            self.flush()
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO jobs (kind, key, created_at) VALUES (?, ?, ?)',
+                                  ((kind, key, now) for key in keys))
+            self.conn.execute('COMMIT')
+
+    def import_done_file(self, kind, path):
+        """Mark every job listed in an old done_*.txt file as done, once per file."""
+        marker = 'imported:%s' % os.path.abspath(path)
+        if not os.path.isfile(path) or self.conn.execute('SELECT 1 FROM meta WHERE key = ?', (marker,)).fetchone():
+            return
+        now = time.time()
+        with open(path) as done_file:
+            keys = set(line.strip() for line in done_file if line.strip())
+        with self._lock:
+            self.flush()
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR REPLACE INTO jobs (kind, key, state, created_at, finished_at) VALUES (?, ?, ?, ?, ?)',
+                                  ((kind, key, DONE, now, now) for key in keys))
+            self.conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)', (marker, str(len(keys))))
+            self.conn.execute('COMMIT')
+        print('Imported %d done %s jobs from %s' % (len(keys), kind, path))
+
+    def pending(self, kind, shard=None, shards=None):
+        """Return the keys of all jobs of this kind that still need to run, in insertion order.
+
+        With shard and shards, only return the jobs assigned to that shard.
+        """
+        self.flush()
+        if shard is None:
+            rows = self.conn.execute('SELECT key FROM jobs WHERE kind = ? AND state IN (?, ?, ?) ORDER BY rowid',
+                                     (kind,) + UNFINISHED)
+        else:
+            rows = self.conn.execute('SELECT key FROM jobs WHERE kind = ? AND state IN (?, ?, ?) AND shard_of(key, ?) = ? ORDER BY rowid',
+                                     (kind,) + UNFINISHED + (shards, shard))
+        return [key for key, in rows]
+
+    def keys(self, kind, state):
+        """Return the keys of all jobs of this kind in one state."""
+        self.flush()
+        return [key for key, in self.conn.execute('SELECT key FROM jobs WHERE kind = ? AND state = ?', (kind, state))]
+
+    def claim(self, kind, key):
+        """Claim a job for this process, registering it if it is new.
+
+        Return False if the job is already finished, or was already claimed during this run.
+        """
+        with self._lock:
+            if (kind, key) in self._claimed:
+                return False
+            row = self.conn.execute('SELECT state FROM jobs WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+            if row is not None and row[0] not in UNFINISHED:
+                return False
+            if row is None:
+                self._enqueue('INSERT OR IGNORE INTO jobs (kind, key, created_at) VALUES (?, ?, ?)', (kind, key, time.time()))
+            self._claimed.add((kind, key))
+            return True
+
+    def record_search(self, formula, ids):
+        """Record which NIST IDs a formula search returned, registering each as an ID job."""
+        now = time.time()
+        with self._lock:
+            self._enqueue('INSERT OR REPLACE INTO searches VALUES (?, ?, ?)', (formula, len(ids), now))
+            for nistid in ids:
+                self._enqueue('INSERT OR IGNORE INTO search_results VALUES (?, ?)', (formula, nistid))
+                self._enqueue('INSERT OR IGNORE INTO jobs (kind, key, created_at) VALUES (?, ?, ?)', ('id', nistid, now))
+
+    def searches(self):
+        """Return {formula: number of IDs returned} for every recorded search."""
+        self.flush()
+        return dict(self.conn.execute('SELECT formula, result_count FROM searches'))
+
+    def record_spectrum_indices(self, nistid, stype, indices):
+        """Cache the spectrum indices discovered for an ID, so they are never looked up again."""
+        now = time.time()
+        for index in indices:
+            self._enqueue('INSERT OR IGNORE INTO spectrum_indices VALUES (?, ?, ?, ?)', (nistid, stype, index, now))
+
+    def spectrum_indices(self, nistid, stype):
+        """Return the cached spectrum indices for an ID, or an empty list if they haven't been discovered."""
+        self.flush()
+        rows = self.conn.execute('SELECT idx FROM spectrum_indices WHERE nistid = ? AND type = ? ORDER BY idx', (nistid, stype))
+        return [index for index, in rows]
+
+    def record_validators(self, nistid, stype, idx, etag, last_modified, sha256):
+        """Store the HTTP validators and content hash of the latest download of an artifact."""
+        self._enqueue('INSERT OR REPLACE INTO validators VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (nistid, stype, idx, etag, last_modified, sha256, time.time()))
+
+    def validators(self, nistid, stype, idx):
+        """Return {'etag', 'last_modified', 'sha256'} for an artifact, or None if none were stored."""
+        self.flush()
+        row = self.conn.execute('SELECT etag, last_modified, sha256 FROM validators WHERE nistid = ? AND type = ? AND idx = ?',
+                                (nistid, stype, idx)).fetchone()
+        return None if row is None else dict(zip(('etag', 'last_modified', 'sha256'), row))
+
+    def record_not_found(self, nistid, stype, idx):
+        """Remember that NIST answered an artifact request with its "not found" sentinel."""
+        self._enqueue('INSERT OR REPLACE INTO not_found VALUES (?, ?, ?, ?)', (nistid, stype, idx, time.time()))
+
+    def not_found(self, nistid, stype, idx, ttl):
+        """Return True if NIST reported an artifact missing less than `ttl` seconds ago.
+
+        Doesn't flush, so a lookup never forces out the current batch.
+        """
+        with self._lock:
+            row = self.conn.execute('SELECT checked_at FROM not_found WHERE nistid = ? AND type = ? AND idx = ?',
+                                    (nistid, stype, idx)).fetchone()
+        return row is not None and time.time() - row[0] < ttl
+
+    def reset(self, kind):
+        """Put every job of one kind back to pending, e.g. to start a new refresh round."""
+        self._enqueue('UPDATE jobs SET state = ?, error = NULL WHERE kind = ?', (PENDING, kind))
+        self.flush()
+
+    def start(self, kind, key):
+        """Record that a job is in flight."""
+        self._enqueue('UPDATE jobs SET state = ?, attempts = attempts + 1, started_at = ? WHERE kind = ? AND key = ?',
+                      (IN_FLIGHT, time.time(), kind, key))
+
+    def finish(self, kind, key, state, nbytes=0, error=None):
+        """Record the outcome of a job: DONE, NOT_FOUND or FAILED. A failed job can be claimed again."""
+        if state == FAILED:
+            with self._lock:
+                self._claimed.discard((kind, key))
+        self._enqueue('UPDATE jobs SET state = ?, bytes = ?, error = ?, finished_at = ? WHERE kind = ? AND key = ?',
+                      (state, nbytes, error, time.time(), kind, key))
+
+    def set_meta(self, key, value):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def create_shards(self, phase, shards):
+        """Register `shards` unclaimed shards for one phase of a sharded run, releasing any that had failed jobs."""
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO shards (phase, shard) VALUES (?, ?)', ((phase, shard) for shard in range(shards)))
+            self.conn.execute('UPDATE shards SET state = ?, owner = NULL WHERE phase = ? AND state = ?', (PENDING, phase, FAILED))
+            self.conn.execute('COMMIT')
+
+    def claim_shard(self, phase, owner, stale_after=3600):
+        """Atomically claim an unclaimed shard of a phase, or one whose owner stopped heartbeating.
+
+        Return the shard number, or None if every shard is claimed or done.
+        """
+        now = time.time()
+        with self._lock:
+            self.flush()
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute('SELECT shard FROM shards WHERE phase = ? AND (state = ? OR (state = ? AND heartbeat < ?)) ORDER BY shard LIMIT 1',
+                                    (phase, PENDING, CLAIMED, now - stale_after)).fetchone()
+            if row is not None:
+                self.conn.execute('UPDATE shards SET state = ?, owner = ?, heartbeat = ? WHERE phase = ? AND shard = ?',
+                                  (CLAIMED, owner, now, phase, row[0]))
+            self.conn.execute('COMMIT')
+        return None if row is None else row[0]
+
+    def heartbeat(self, phase, shard, owner):
+        """Show that the owner of a shard is still working on it."""
+        with self._lock:
+            self.conn.execute('UPDATE shards SET heartbeat = ? WHERE phase = ? AND shard = ? AND owner = ?', (time.time(), phase, shard, owner))
+
+    def finish_shard(self, phase, shard, failed=False):
+        """Mark a shard done, or failed if some of its jobs failed, so the next coordinated run releases it again."""
+        with self._lock:
+            self.flush()
+            self.conn.execute('UPDATE shards SET state = ? WHERE phase = ? AND shard = ?', (FAILED if failed else DONE, phase, shard))
+
+    def phase_done(self, phase):
+        """Return True once every shard of a phase is done or failed."""
+        return not self.conn.execute('SELECT 1 FROM shards WHERE phase = ? AND state NOT IN (?, ?) LIMIT 1', (phase, DONE, FAILED)).fetchone()
+
+    def counts(self, kind):
+        """Return a {state: number of jobs} summary for one kind of job."""
+        self.flush()
+        return dict(self.conn.execute('SELECT state, COUNT(*) FROM jobs WHERE kind = ? GROUP BY state', (kind,)))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Local stand-in for the NIST Chemistry WebBook endpoints the scraper uses, for offline benchmarks.
+
+Replays saved formula search pages (see the scraper's --save-search-pages), jdx and mol files,
+answering with NIST's "not found" sentinels for anything it doesn't have. It can enforce NIST's
+rate limit, add latency and inject failures. Point the scraper at it with
+`--base-url http://127.0.0.1:8000/cgi/cbook.cgi` or the NIST_URL environment variable.
+"""
+import argparse
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+CGI_PATH = '/cgi/cbook.cgi'
+# Must match what the scraper checks for
+JDX_NOT_FOUND = '##TITLE=Spectrum not found.\n##END=\n'
+MOL_NOT_FOUND = 'NIST    12121112142D 1   1.00000     0.00000\nCopyright by the U.S. Sec. Commerce on behalf of U.S.A. All rights reserved.\n0  0  0     0  0              1 V2000\nM  END\n'
+EMPTY_SEARCH = '<html><head><title>Search Results</title></head><body><p>No matching species found.</p></body></html>\n'
+JDX_NAME_RE = re.compile(r'^(.*)-IR(?:-(\d+))?\.jdx$')
+
+
+class StandinState:
+    """What the stand-in serves, the faults it injects, and counts of what it did."""
+
+    def __init__(self, search_dir, jdx_dir, mol_dir, limit=5, period=30.0, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.search_dir = search_dir
+        self.jdx_dir = jdx_dir
+        self.mol_dir = mol_dir
+        self.limit = limit
+        self.period = period
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.counts = Counter()
+        self._requests = deque()
+        self._lock = threading.Lock()
+        # Index numbers of the IR spectra saved for each ID, for the IR spectrum pages
+        self.ir_indices = {}
+        if os.path.isdir(jdx_dir):
+            for name in os.listdir(jdx_dir):
+                match = JDX_NAME_RE.match(name)
+                if match:
+                    self.ir_indices.setdefault(match.group(1), set()).add(int(match.group(2) or 0))
+
+    def retry_after(self):
+        """Count a request against the rate limit. Return 0 if it is allowed, else the seconds until it would be."""
+        if not self.limit:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            while self._requests and now - self._requests[0] >= self.period:
+                self._requests.popleft()
+            if len(self._requests) >= self.limit:
+                return self._requests[0] + self.period - now
+            self._requests.append(now)
+            return 0
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+
+def read_file(path):
+    try:
+        with open(path, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def send_body(self, status, body, content_type='text/plain', headers=()):
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for header in headers:
+                self.send_header(*header)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_payload(self, body, content_type):
+            """Send a replayed payload, honouring If-None-Match so the scraper's refresh mode gets 304s."""
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+            if self.headers.get('If-None-Match') == etag:
+                state.count('not-modified')
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_body(200, body, content_type, [('ETag', etag)])
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path != CGI_PATH:
+                self.send_body(404, 'Not found\n')
+                return
+            delay = state.retry_after()
+            if delay:
+                state.count('throttled')
+                self.send_body(429, 'Too many requests\n', headers=[('Retry-After', str(int(delay) + 1))])
+                return
+            if state.latency or state.jitter:
+                time.sleep(max(0.0, random.gauss(state.latency, state.jitter)))
+            if random.random() < state.failure_rate:
+                state.count('failed')
+                if random.random() < 0.5:
+                    self.send_body(503, 'Service unavailable\n')
+                else:
+                    # Drop the connection without a response
+                    self.close_connection = True
+                return
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if 'Formula' in query:
+                state.count('search')
+                page = read_file(os.path.join(state.search_dir, '%s.html' % re.sub('[^A-Za-z0-9]', '_', query['Formula'])))
+                self.send_body(200, page if page is not None else EMPTY_SEARCH, 'text/html')
+            elif 'JCAMP' in query:
+                state.count('jdx')
+                index = int(query.get('Index', 0))
+                name = '%s-%s%s.jdx' % (query['JCAMP'], query.get('Type', 'IR'), '-%d' % index if index else '')
+                body = read_file(os.path.join(state.jdx_dir, name))
+                if body is None:
+                    self.send_body(200, JDX_NOT_FOUND)
+                else:
+                    self.send_payload(body, 'chemical/x-jcamp-dx')
+            elif 'Str2File' in query:
+                state.count('mol')
+                body = read_file(os.path.join(state.mol_dir, '%s.mol' % query['Str2File']))
+                if body is None:
+                    self.send_body(200, MOL_NOT_FOUND)
+                else:
+                    self.send_payload(body, 'chemical/x-mdl-molfile')
+            elif 'ID' in query:
+                state.count('page')
+                links = ''.join('<a href="%s?ID=%s&amp;Units=SI&amp;Type=IR-SPEC&amp;Index=%d#IR-SPEC">Spectrum %d</a>\n'
+                                % (CGI_PATH, query['ID'], index, index) for index in sorted(state.ir_indices.get(query['ID'], ())))
+                self.send_body(200, '<html><body>%s</body></html>\n' % links, 'text/html')
+            else:
+                self.send_body(400, 'Unknown request\n')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--search-pages', default='search_pages', help='directory of saved formula search result pages')
+    parser.add_argument('--jdx', default='jdx', help='directory of jdx files to serve')
+    parser.add_argument('--mol', default='mol', help='directory of mol files to serve')
+    parser.add_argument('--limit', type=int, default=5, help='requests allowed per --period, 0 for no limit')
+    parser.add_argument('--period', type=float, default=30.0, help='rate limit window in seconds')
+    parser.add_argument('--latency', type=float, default=0.0, help='mean seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='standard deviation of the added latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests answered with a 503 or a dropped connection')
+    args = parser.parse_args()
+    state = StandinState(args.search_pages, args.jdx, args.mol, args.limit, args.period, args.latency, args.jitter, args.failure_rate)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    print('Serving NIST stand-in at http://%s:%d%s' % (args.host, args.port, CGI_PATH))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Requests served: %s' % dict(state.counts))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Content-addressed, compressed pack file storage for downloaded JCAMP and MOL files.
+
+Instead of one small file per spectrum, payloads are zlib-compressed and appended to one of
+`shards` pack files, chosen by the SHA-256 of the payload. Identical payloads are stored once.
+An SQLite index maps (NIST ID, type, index) to a digest and each digest to its (shard, offset,
+length), and is held in memory so any record can be read back with a single pread.
+"""
+import argparse
+import hashlib
+import io
+import os
+import sqlite3
+import struct
+import threading
+import zlib
+
+PACK_DIR = 'packs'
+SHARDS = 16
+# Every record in a pack file is MAGIC, the 32 byte SHA-256 digest, the compressed length and the payload
+MAGIC = b'NPK1'
+HEADER = struct.Struct('>4s32sI')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    sha256 TEXT PRIMARY KEY,
+    shard INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    nistid TEXT NOT NULL,
+    type TEXT NOT NULL,
+    idx INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT NOT NULL,
+    PRIMARY KEY (nistid, type, idx)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class PackStore:
+    """Sharded pack file store. type is 'mol' for MOL files and the spectrum type (e.g. 'IR') for jdx files."""
+
+    def __init__(self, root=PACK_DIR, shards=SHARDS, level=6):
+        self.root = root
+        self.level = level
+        os.makedirs(root, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(root, 'index.db'), timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        # The shard count of an existing store wins, so digests keep mapping to the same pack files
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO meta VALUES ('shards', ?)", (str(shards),))
+        self.shards = int(self.conn.execute("SELECT value FROM meta WHERE key = 'shards'").fetchone()[0])
+        self._blobs = {row[0]: row[1:] for row in self.conn.execute('SELECT sha256, shard, offset, length, size FROM blobs')}
+        self._records = {row[:3]: row[3] for row in self.conn.execute('SELECT nistid, type, idx, sha256 FROM records')}
+        self._lock = threading.Lock()
+        self._shard_locks = [threading.Lock() for _ in range(self.shards)]
+        self._writers = {}
+        self._readers = {}
+
+    def _pack_path(self, shard):
+        return os.path.join(self.root, 'pack-%02x.pack' % shard)
+
+    def _reader(self, shard):
+        with self._lock:
+            fd = self._readers.get(shard)
+            if fd is None:
+                fd = self._readers[shard] = os.open(self._pack_path(shard), os.O_RDONLY)
+            return fd
+
+    def __len__(self):
+        return len(self._records)
+
+    def has(self, nistid, stype, idx=0):
+        return (nistid, stype, idx) in self._records
+
+    def keys(self, stype=None):
+        """Return the (nistid, type, idx) of every record, or those of one type, sorted by NIST ID."""
+        return sorted(key for key in self._records if stype is None or key[1] == stype)
+
+    def digest(self, nistid, stype, idx=0):
+        """Return the SHA-256 digest of the record for an ID, or None if there is no such record."""
+        return self._records.get((nistid, stype, idx))
+
+    def put(self, nistid, stype, data, idx=0):
+        """Store data for an ID and return its SHA-256 digest. Payloads already in the store aren't written again."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            known = digest in self._blobs
+        if not known:
+            shard = int(digest[:8], 16) % self.shards
+            compressed = zlib.compress(data, self.level)
+            with self._shard_locks[shard]:
+                writer = self._writers.get(shard)
+                if writer is None:
+                    writer = self._writers[shard] = open(self._pack_path(shard), 'ab')
+                writer.write(HEADER.pack(MAGIC, bytes.fromhex(digest), len(compressed)))
+                offset = writer.tell()
+                writer.write(compressed)
+                writer.flush()
+                # The record must be on disk before the index says it exists
+                os.fsync(writer.fileno())
+            blob = (shard, offset, len(compressed), len(data))
+        with self._lock:
+            with self.conn:
+                if not known and digest not in self._blobs:
+                    self._blobs[digest] = blob
+                    self.conn.execute('INSERT INTO blobs VALUES (?, ?, ?, ?, ?)', (digest,) + blob)
+                self._records[(nistid, stype, idx)] = digest
+                self.conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', (nistid, stype, idx, digest))
+        return digest
+
+    def get(self, nistid, stype, idx=0):
+        """Return the stored bytes for an ID, or None if there is no such record."""
+        digest = self._records.get((nistid, stype, idx))
+        if digest is None:
+            return None
+        shard, offset, length, size = self._blobs[digest]
+        data = zlib.decompress(os.pread(self._reader(shard), length, offset))
+        if len(data) != size:
+            raise IOError('Corrupt record for %s %s in %s' % (nistid, stype, self._pack_path(shard)))
+        return data
+
+    def text(self, nistid, stype, idx=0):
+        """Return the stored record decoded as text, or None if there is no such record."""
+        data = self.get(nistid, stype, idx)
+        return None if data is None else data.decode('utf-8', errors='replace')
+
+    def open(self, nistid, stype, idx=0):
+        """Return a text file object over a record, e.g. for jcamp.jcamp_read or RDKit."""
+        return io.StringIO(self.text(nistid, stype, idx))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        for fd in self._readers.values():
+            os.close(fd)
+        self._writers, self._readers = {}, {}
+        self.conn.close()
+
+
+def main():
+    """Pack an existing jdx/ and mol/ tree into a pack store."""
+    from artifact_manifest import parse_filename
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--root', default=PACK_DIR)
+    parser.add_argument('--shards', type=int, default=SHARDS)
+    parser.add_argument('--jdx', default='jdx')
+    parser.add_argument('--mol', default='mol')
+    args = parser.parse_args()
+    store = PackStore(args.root, args.shards)
+    for directory in (args.jdx, args.mol):
+        for entry in os.scandir(directory):
+            parsed = parse_filename(entry.name)
+            if parsed is not None and not store.has(*parsed):
+                with open(entry.path, 'rb') as file:
+                    store.put(parsed[0], parsed[1], file.read(), parsed[2])
+    print('%s: %d records in %d unique payloads' % (args.root, len(store), len(store._blobs)))
+    store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Thread-safe rate limiting shared by every request the NIST scraper makes."""
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """Token bucket allowing at most `capacity` requests in any `period` second window.
+
+    A token taken by acquire is held until release is called once its request has completed,
+    and goes back into the bucket `period` seconds after that. Timing the window from the
+    response rather than from the acquire means a slow connect or send can't bring two requests
+    closer together at the server than `period`, so the bucket enforces the same sliding window
+    as NIST (5 requests per 30 seconds) while any number of worker threads draw from it.
+    """
+
+    def __init__(self, capacity=5, period=30.0):
+        self.capacity = capacity
+        self.period = period
+        self._taken = deque()
+        self._in_flight = 0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        """Return tokens whose window has passed to the bucket."""
+        while self._taken and now - self._taken[0] >= self.period:
+            self._taken.popleft()
+
+    def _delay(self, now):
+        """Return the seconds until a token can be taken, or 0 if one can be taken now. Call with the lock held."""
+        self._refill(now)
+        if len(self._taken) + self._in_flight < self.capacity:
+            return 0.0
+        if not self._taken:
+            # Every token is held by a request in flight; release wakes the waiters
+            return self.period
+        return self._taken[0] + self.period - now
+
+    def acquire(self):
+        """Block until a token is available, take it and return the seconds spent waiting. Call release when the request is done."""
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                delay = self._delay(now)
+                if delay <= 0:
+                    self._in_flight += 1
+                    return now - start
+                self._cond.wait(delay)
+
+    def release(self):
+        """Start the window of a token taken by acquire, now that its request has completed (or failed)."""
+        with self._cond:
+            self._in_flight -= 1
+            self._taken.append(time.monotonic())
+            self._cond.notify_all()
+
+    def available(self):
+        """Return the number of tokens that can be taken right now without waiting."""
+        with self._cond:
+            self._refill(time.monotonic())
+            return max(0, self.capacity - len(self._taken) - self._in_flight)
+
+
+def retry_after_seconds(value):
+    """Parse a Retry-After header (seconds or an HTTP date) into seconds from now, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveTokenBucket(TokenBucket):
+    """TokenBucket whose capacity adapts to the server's responses (additive increase, multiplicative decrease).
+
+    After every `period` without a throttling or server error in which the budget was used up, the
+    capacity grows by one request, up to `max_capacity`. A 429/5xx response or connection error halves
+    it, at most once per period, down to `min_capacity`. A Retry-After header pauses all requests for
+    as long as the server asks. The capacity settles just below the highest rate the server tolerates.
+    """
+
+    def __init__(self, capacity=5, period=30.0, min_capacity=1, max_capacity=20, decrease=0.5):
+        super().__init__(capacity, period)
+        self.min_capacity = min_capacity
+        self.max_capacity = max_capacity
+        self.decrease = decrease
+        self.paused_until = 0.0
+        self.increases = 0
+        self.decreases = 0
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self._window_errors = 0
+        self._last_error_rate = 0.0
+        self._last_decrease = float('-inf')
+
+    def _delay(self, now):
+        return max(self.paused_until - now, super()._delay(now))
+
+    def record(self, status, retry_after=None):
+        """Feed back the outcome of a request: its HTTP status (None for a connection error) and Retry-After header."""
+        now = time.monotonic()
+        error = status is None or status == 429 or status >= 500
+        with self._cond:
+            self._roll_window(now)
+            self._window_requests += 1
+            if not error:
+                return
+            self._window_errors += 1
+            delay = retry_after_seconds(retry_after)
+            if delay:
+                self.paused_until = max(self.paused_until, now + delay)
+            if now - self._last_decrease >= self.period:
+                self.capacity = max(self.min_capacity, int(self.capacity * self.decrease))
+                self._last_decrease = now
+                self.decreases += 1
+            self._cond.notify_all()
+
+    def _roll_window(self, now):
+        """Close the current window once it is `period` long, growing the capacity if it went well."""
+        if now - self._window_start < self.period:
+            return
+        if not self._window_errors and self._window_requests >= self.capacity and self.capacity < self.max_capacity:
+            self.capacity += 1
+            self.increases += 1
+            self._cond.notify_all()
+        self._last_error_rate = self._window_errors / self._window_requests if self._window_requests else 0.0
+        self._window_start = now
+        self._window_requests = 0
+        self._window_errors = 0
+
+    def metrics(self):
+        """Return the current rate and backoff state."""
+        with self._cond:
+            now = time.monotonic()
+            self._roll_window(now)
+            return {
+                'capacity': self.capacity,
+                'period': self.period,
+                'rate_per_second': self.capacity / self.period,
+                'paused_for': max(0.0, self.paused_until - now),
+                'increases': self.increases,
+                'decreases': self.decreases,
+                'window_requests': self._window_requests,
+                'window_errors': self._window_errors,
+                'last_window_error_rate': self._last_error_rate,
+            }
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Buffered, rotating log writer that keeps the most recent lines in memory."""
+import gzip
+import os
+import shutil
+import threading
+import time
+from collections import deque
+
+
+class RotatingLog:
+    """Append-only log file that is rotated once it reaches `max_bytes` or is `max_age` seconds old.
+
+    Lines are buffered and written every `flush_lines` lines or `flush_interval` seconds. Rotated
+    files are renamed path.1, path.2, ... (gzip compressed as path.1.gz, ... with compress), and
+    only the newest `backups` are kept. The last `recent` lines are kept in memory in `self.recent`.
+    """
+
+    def __init__(self, path, max_bytes=50 * 2 ** 20, max_age=None, backups=5, compress=True,
+                 flush_lines=100, flush_interval=2.0, recent=500):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+        self.compress = compress
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.recent = deque(maxlen=recent)
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'a')
+        self._size = self._file.tell()
+        self._opened = time.time()
+        self._flushed = time.monotonic()
+
+    def _backup_path(self, n):
+        return '%s.%d%s' % (self.path, n, '.gz' if self.compress else '')
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._backup_path(n)):
+                os.replace(self._backup_path(n), self._backup_path(n + 1))
+        if self.compress:
+            with open(self.path, 'rb') as source, gzip.open(self._backup_path(1), 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self._backup_path(1))
+        self._open()
+
+    def write(self, line):
+        """Buffer a line (without its newline) for the log file."""
+        with self._lock:
+            self.recent.append(line)
+            self._buffer.append(line + '\n')
+            if len(self._buffer) >= self.flush_lines or time.monotonic() - self._flushed >= self.flush_interval:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._file.write(data)
+            self._file.flush()
+            self._size += len(data)
+        self._flushed = time.monotonic()
+        if self._size >= self.max_bytes or (self.max_age and time.time() - self._opened >= self.max_age):
+            self._rotate()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._file.close()
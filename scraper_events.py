@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Structured events the NIST scraper sends to its supervisor, one JSON object per line.
+
+The supervisor opens a pipe and passes the scraper the number of its write end in the
+SCRAPER_EVENTS_FD environment variable. Without it, emit() does nothing.
+"""
+import json
+import os
+import threading
+import time
+
+EVENTS_FD_ENV = 'SCRAPER_EVENTS_FD'
+
+# Failure categories, from the exception a job failed with
+THROTTLED = 'throttled'
+TIMEOUT = 'timeout'
+CONNECTION = 'connection'
+HTTP = 'http'
+OTHER = 'other'
+
+_lock = threading.Lock()
+_stream = None
+
+
+def _events_stream():
+    global _stream
+    if _stream is None:
+        fd = os.environ.get(EVENTS_FD_ENV)
+        if fd is None:
+            return None
+        _stream = os.fdopen(int(fd), 'w', buffering=1)
+    return _stream
+
+
+def emit(event, **fields):
+    """Send an event with the given fields to the supervisor, if there is one."""
+    with _lock:
+        stream = _events_stream()
+        if stream is None:
+            return
+        fields['event'] = event
+        fields['time'] = time.time()
+        stream.write(json.dumps(fields) + '\n')
+
+
+def classify(error):
+    """Return the failure category of an exception raised by a job."""
+    name = type(error).__name__
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status == 429 or 'Too many requests' in str(error):
+        return THROTTLED
+    if 'Timeout' in name or isinstance(error, TimeoutError):
+        return TIMEOUT
+    if name in ('ConnectionError', 'SSLError', 'ChunkedEncodingError') or isinstance(error, ConnectionError):
+        return CONNECTION
+    if status is not None or name == 'HTTPError':
+        return HTTP
+    return OTHER
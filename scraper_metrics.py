@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Counters, histograms and gauges for a long scraper run, exported in the Prometheus text format.
+
+Metrics can be served on a local HTTP endpoint (serve) and/or written to a JSON snapshot file
+at a fixed interval (write_snapshots).
+"""
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def _format(name, labels, suffix=''):
+    if not labels:
+        return name + suffix
+    return '%s%s{%s}' % (name, suffix, ','.join('%s="%s"' % item for item in labels))
+
+
+class Metrics:
+    """Thread-safe registry of labelled counters and histograms, and of gauges read when exported."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a value (usually seconds) in a histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def time(self, name, **labels):
+        """Context manager recording the seconds spent in its block in a histogram."""
+        return _Timer(self, name, labels)
+
+    def gauge(self, name, function):
+        """Register a gauge whose value is function(), or None to leave it out."""
+        self._gauges[name] = function
+
+    def counter(self, name, **labels):
+        with self._lock:
+            return self._counters.get(_key(name, labels), 0)
+
+    def total(self, name):
+        """Return the sum of a histogram over all its labels."""
+        with self._lock:
+            return sum(histogram[2] for (key, labels), histogram in self._histograms.items() if key == name)
+
+    def snapshot(self):
+        """Return every metric as a JSON-serialisable dict."""
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self._counters.items())]
+            histograms = [{'name': name, 'labels': dict(labels), 'count': count, 'sum': total,
+                           'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], counts))}
+                          for (name, labels), (counts, count, total) in sorted(self._histograms.items())]
+        gauges = {}
+        for name, function in self._gauges.items():
+            value = function()
+            if value is not None:
+                gauges[name] = value
+        return {'time': time.time(), 'uptime': time.time() - self.started, 'counters': counters,
+                'histograms': histograms, 'gauges': gauges}
+
+    def prometheus(self):
+        """Return every metric in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for counter in snapshot['counters']:
+            header(counter['name'], 'counter')
+            lines.append('%s %s' % (_format(counter['name'], sorted(counter['labels'].items())), counter['value']))
+        for histogram in snapshot['histograms']:
+            name, labels = histogram['name'], sorted(histogram['labels'].items())
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append('%s %d' % (_format(name, labels + [('le', bound)], '_bucket'), cumulative))
+            lines.append('%s %d' % (_format(name, labels, '_count'), histogram['count']))
+            lines.append('%s %f' % (_format(name, labels, '_sum'), histogram['sum']))
+        for name, value in sorted(snapshot['gauges'].items()):
+            header(name, 'gauge')
+            lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve the metrics at http://host:port/metrics from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode(), 'application/json'
+                else:
+                    body, content_type = metrics.prometheus().encode(), 'text/plain; version=0.0.4'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def write_snapshot(self, path):
+        with open(path + '.tmp', 'w') as snapshot_file:
+            json.dump(self.snapshot(), snapshot_file, indent=1)
+        os.replace(path + '.tmp', path)
+
+    def write_snapshots(self, path, interval=30.0):
+        """Rewrite a JSON snapshot file every `interval` seconds from a background thread."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.write_snapshot(path)
+        threading.Thread(target=loop, daemon=True).start()
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Extract the NIST IDs a formula search result page links to.
+
+extract_ids makes a single regex pass over the raw HTML, falling back to a BeautifulSoup parse
+for pages the regex finds nothing in but that do link to compounds.
+"""
+import html
+import re
+
+# Compound links on a result page, as BeautifulSoup sees their (unescaped) href
+ID_RE = re.compile('/cgi/cbook.cgi\\?ID=(.*?)&')
+# The same links in the raw HTML, where the '&' after the ID is usually written '&amp;'
+ID_LINK_RE = re.compile(r'''<a\s[^>]*?href\s*=\s*["']/cgi/cbook\.cgi\?ID=([^&"'>]*)&''', re.IGNORECASE)
+ID_LINK_HINT = 'cbook.cgi?ID='
+
+
+def extract_ids_fast(page):
+    """Return the NIST ID of every compound link in a result page, in page order, with one regex pass."""
+    return [html.unescape(nistid) for nistid in ID_LINK_RE.findall(page)]
+
+
+def extract_ids_soup(page):
+    """Return the NIST ID of every compound link in a result page by parsing it with BeautifulSoup."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(page, 'html.parser')
+    return [ID_RE.match(link['href']).group(1) for link in soup('a', href=ID_RE) if ID_RE.match(link['href'])]
+
+
+def extract_ids(page):
+    """Return the NIST IDs a result page links to, parsing it with BeautifulSoup only if the regex pass finds none."""
+    ids = extract_ids_fast(page)
+    if not ids and ID_LINK_HINT in page:
+        ids = extract_ids_soup(page)
+    return ids
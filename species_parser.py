@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Streaming parser for species.txt, the NIST species list the scraper works through.
+
+Each line is tab separated: name, formula and CAS number, with an empty field or 'N/A' where a
+value is missing. A line without tabs is taken to be a bare NIST ID.
+"""
+import os
+import pickle
+import re
+import zlib
+from collections import namedtuple
+
+SPECIES_PATH = 'species.txt'
+CACHE_SUFFIX = '.cache'
+MISSING = ('', 'N/A')
+CAS_RE = re.compile(r'^(\d{2,7})-(\d{2})-(\d)$')
+
+# Missing fields are None
+Species = namedtuple('Species', ['name', 'formula', 'cas', 'nistid'])
+
+
+def _field(value):
+    value = value.strip()
+    return None if value in MISSING else value
+
+
+def iter_species(path=SPECIES_PATH):
+    """Lazily yield a Species record for every non-blank line of a species file."""
+    with open(path, encoding='utf-8', errors='replace') as species_file:
+        for line in species_file:
+            line = line.rstrip('\r\n')
+            if not line.strip():
+                continue
+            if '\t' not in line:
+                yield Species(None, None, None, line.strip())
+                continue
+            fields = line.split('\t') + [''] * 2
+            yield Species(_field(fields[0]), _field(fields[1]), _field(fields[2]), None)
+
+
+def unique_formulae(records):
+    """Yield each formula once, in the order it first appears."""
+    seen = set()
+    for record in records:
+        if record.formula is not None and record.formula not in seen:
+            seen.add(record.formula)
+            yield record.formula
+
+
+def lookup_ids(records):
+    """Yield each ID to fetch directly once: bare NIST IDs, and the NIST IDs of the CAS numbers of species
+    without a formula ('64-17-5' -> 'C64175'). Invalid CAS numbers are skipped."""
+    seen = set()
+    for record in records:
+        nistid = record.nistid or (cas_to_nistid(record.cas) if record.formula is None else None)
+        if nistid is not None and nistid not in seen:
+            seen.add(nistid)
+            yield nistid
+
+
+def cas_to_nistid(cas):
+    """Return the NIST ID of a species from its CAS number ('64-17-5' -> 'C64175'), or None if it isn't one."""
+    match = CAS_RE.match(cas or '')
+    return 'C' + ''.join(match.groups()) if match else None
+
+
+def load_species(path=SPECIES_PATH):
+    """Return every Species record in a species file, cached next to it so restarts skip parsing.
+
+    The cache holds the record count and each field as one NUL-joined column, zlib compressed, and
+    is invalidated when the file's size or mtime changes.
+    """
+    cache_path = path + CACHE_SUFFIX
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            cached_signature, count, columns = pickle.loads(zlib.decompress(cache_file.read()))
+        if cached_signature == signature:
+            if not count:
+                return []
+            return [Species._make(value or None for value in row) for row in zip(*(column.split('\0') for column in columns))]
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError, zlib.error):
+        pass
+    records = list(iter_species(path))
+    columns = ['\0'.join(getattr(record, field) or '' for record in records) for field in Species._fields]
+    with open(cache_path + '.tmp', 'wb') as cache_file:
+        cache_file.write(zlib.compress(pickle.dumps((signature, len(records), columns), protocol=pickle.HIGHEST_PROTOCOL), 1))
+    os.replace(cache_path + '.tmp', cache_path)
+    return records
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Binary format of the preprocessed NIST IR dataset.
+
+A dataset is a directory holding
+    spectra.npy  float32 matrix, one row per spectrum and one column per GRID wavenumber
+    grid.npy     the wavenumber of every column
+    smiles.txt   the SMILES of every row, one per line
+    nistids.txt  the NIST ID of every row, one per line
+The matrix is loaded as a read-only memory map, so opening even the full dataset copies nothing.
+load_spectra also reads the older CSV format, and running this module converts such a CSV.
+"""
+import argparse
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+
+from spectra_resampler import GRID
+
+DATASET_PATH = 'NIST Gaseous IR Dataset'
+
+Dataset = namedtuple('Dataset', ['spectra', 'smiles', 'nistids', 'grid'])
+
+
+def _write_lines(path, values):
+    with open(path, 'w', encoding='utf-8') as lines_file:
+        for value in values:
+            lines_file.write('%s\n' % value)
+
+
+def _read_lines(path):
+    with open(path, encoding='utf-8') as lines_file:
+        return np.array(lines_file.read().splitlines(), dtype=object)
+
+
+def write_dataset(spectra, smiles, nistids=None, path=DATASET_PATH, grid=GRID):
+    """Write a spectra matrix and the SMILES (and NIST ID) of each row as a dataset directory.
+
+    The dataset is written next to path and renamed into place. A previous dataset is renamed
+    aside first and only deleted once the new one is in place.
+    """
+    spectra = np.ascontiguousarray(spectra, dtype=np.float32)
+    if spectra.shape != (len(smiles), len(grid)):
+        raise ValueError('spectra is %s, expected (%d, %d)' % (spectra.shape, len(smiles), len(grid)))
+    if nistids is not None and len(nistids) != len(smiles):
+        raise ValueError('%d NIST IDs for %d rows' % (len(nistids), len(smiles)))
+    partial = path + '.part'
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    np.save(os.path.join(partial, 'spectra.npy'), spectra)
+    np.save(os.path.join(partial, 'grid.npy'), np.asarray(grid))
+    _write_lines(os.path.join(partial, 'smiles.txt'), smiles)
+    _write_lines(os.path.join(partial, 'nistids.txt'), nistids if nistids is not None else [''] * len(smiles))
+    previous = path + '.old'
+    shutil.rmtree(previous, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, previous)
+    os.replace(partial, path)
+    shutil.rmtree(previous, ignore_errors=True)
+
+
+def load_dataset(path=DATASET_PATH, mmap=True):
+    """Load a dataset directory. The spectra are a read-only memory map unless mmap is False."""
+    spectra = np.load(os.path.join(path, 'spectra.npy'), mmap_mode='r' if mmap else None)
+    smiles = _read_lines(os.path.join(path, 'smiles.txt'))
+    nistids = _read_lines(os.path.join(path, 'nistids.txt'))
+    grid = np.load(os.path.join(path, 'grid.npy'))
+    if not len(smiles) == len(nistids) == spectra.shape[0] or spectra.shape[1] != len(grid):
+        raise ValueError('%s is inconsistent: %s spectra, %d SMILES, %d NIST IDs, %d grid points' % (
+            path, spectra.shape, len(smiles), len(nistids), len(grid)))
+    return Dataset(spectra, smiles, nistids, grid)
+
+
+def read_csv_dataset(path):
+    """Read a dataset CSV (a SMILES column and one column per grid point) in one vectorized pass.
+
+    Return (smiles, spectra), with as many rows as the file has.
+    """
+    import pandas as pd
+    frame = pd.read_csv(path)
+    columns = sorted((column for column in frame.columns if str(column).isdigit()), key=int)
+    return frame['SMILES'].to_numpy(dtype=object), frame[columns].to_numpy(dtype=np.float32)
+
+
+def load_spectra(path=DATASET_PATH):
+    """Return (smiles, spectra) from a dataset directory (spectra memory mapped) or a dataset CSV."""
+    if os.path.isdir(path):
+        dataset = load_dataset(path)
+        return dataset.smiles, dataset.spectra
+    return read_csv_dataset(path)
+
+
+def main():
+    """Convert a dataset CSV into the binary dataset format."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('csv', help='dataset CSV to convert')
+    parser.add_argument('--output', default=DATASET_PATH, help='dataset directory to write')
+    args = parser.parse_args()
+    smiles, spectra = read_csv_dataset(args.csv)
+    grid = GRID if spectra.shape[1] == len(GRID) else np.arange(spectra.shape[1])
+    write_dataset(spectra, smiles, path=args.output, grid=grid)
+    print('%s: %d spectra of %d points' % (args.output, spectra.shape[0], spectra.shape[1]))
+
+
+if __name__ == '__main__':
+    main()
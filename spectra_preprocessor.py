@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Parallel preprocessing of the scraped JCAMP spectra and MOL files, in or outside Jupyter.
+
+Spectra are fanned out in chunks to a process pool, one process per core by default, and come
+back in NIST ID order however the work was split. Each reads its jdx file with jcamp, computes
+its cross sections, converts the matching MOL file to SMILES with RDKit and resamples the
+spectrum onto the dataset grid, in a single pass that either keeps the spectrum or says why it
+was rejected. Only the resampled row travels back from the worker. Run as a script, the kept
+spectra are written as a binary dataset (see spectra_dataset).
+"""
+import argparse
+import os
+from collections import Counter, namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+from jcamp import jcamp_calc_xsec, jcamp_read, jcamp_readfile
+from rdkit import Chem
+from tqdm import tqdm
+
+from artifact_manifest import ArtifactManifest, MANIFEST_PATH
+from pack_store import PackStore
+from spectra_dataset import DATASET_PATH, write_dataset
+from spectra_resampler import GRID, resample_batch
+
+CHUNKSIZE = 64
+REJECTIONS_PATH = 'bad_spectra.txt'
+
+# Why a spectrum was rejected
+UNREADABLE = 'unreadable'
+XSEC_FAILED = 'xsec-failed'
+NOT_GAS = 'not-gas'
+NO_MOL = 'no-mol'
+EMPTY_SMILES = 'empty-smiles'
+
+# spectrum is the absorbance resampled onto GRID, a float32 row
+Processed = namedtuple('Processed', ['nistid', 'smiles', 'spectrum'])
+# detail is the error message, or the state of a non-gas spectrum
+Rejection = namedtuple('Rejection', ['nistid', 'reason', 'detail'])
+
+# Pack store opened in each worker process, when preprocessing from one
+_pack_store = None
+
+
+def _init_worker(pack_dir):
+    global _pack_store
+    if pack_dir is not None:
+        _pack_store = PackStore(pack_dir)
+
+
+def artifact_tasks(manifest=None, pack_store=None, stype='IR'):
+    """Return a (nistid, jdx source, mol source) task for every spectrum of a type, sorted by NIST ID and index.
+
+    Sources are file paths from a manifest, or (nistid, type, idx) keys into a pack store. The mol
+    source is None when there is no MOL file.
+    """
+    tasks = []
+    if pack_store is not None:
+        for key in pack_store.keys(stype):
+            nistid = key[0]
+            tasks.append((nistid, key, (nistid, 'mol', 0) if pack_store.has(nistid, 'mol') else None))
+        return tasks
+    for artifact in manifest.artifacts(stype):
+        molfile = manifest.get(artifact.nistid, 'mol')
+        tasks.append((artifact.nistid, artifact.path, molfile.path if molfile is not None else None))
+    return tasks
+
+
+def read_jcamp(source):
+    """Read a jdx file from a path or a pack store key."""
+    if isinstance(source, tuple):
+        return jcamp_read(_pack_store.open(*source))
+    return jcamp_readfile(source)
+
+
+def read_smiles(source):
+    """Return the SMILES of a MOL file from a path or a pack store key."""
+    if isinstance(source, tuple):
+        mol = Chem.MolFromMolBlock(_pack_store.text(*source))
+    else:
+        mol = Chem.MolFromMolFile(source)
+    return Chem.MolToSmiles(mol)
+
+
+def process_artifact(task):
+    """Preprocess one spectrum, parsing its files once. Return a Processed record with the spectrum resampled
+    onto GRID, or a Rejection saying why it can't be used."""
+    nistid, jdx_source, mol_source = task
+    try:
+        spectrum = read_jcamp(jdx_source)
+    except Exception as error:
+        return Rejection(nistid, UNREADABLE, '%s: %s' % (type(error).__name__, error))
+    try:
+        jcamp_calc_xsec(spectrum, skip_nonquant=False)
+    except Exception as error:
+        return Rejection(nistid, XSEC_FAILED, '%s: %s' % (type(error).__name__, error))
+    state = str(spectrum.get('state', 'gas')).strip()
+    if not state.lower().startswith('gas'):
+        return Rejection(nistid, NOT_GAS, state)
+    if mol_source is None:
+        return Rejection(nistid, NO_MOL, None)
+    try:
+        smiles = read_smiles(mol_source)
+    except Exception as error:
+        return Rejection(nistid, EMPTY_SMILES, '%s: %s' % (type(error).__name__, error))
+    if not smiles:
+        return Rejection(nistid, EMPTY_SMILES, None)
+    return Processed(nistid, smiles, resample_batch([spectrum])[0])
+
+
+def preprocess(tasks, processes=None, chunksize=CHUNKSIZE, pack_dir=None):
+    """Yield process_artifact(task) for every task, in task order, computed on a pool of `processes` processes."""
+    with Pool(processes, initializer=_init_worker, initargs=(pack_dir,)) as pool:
+        for result in pool.imap(process_artifact, tasks, chunksize):
+            yield result
+
+
+def rejection_counts(rejections):
+    """Return a Counter of rejections by reason."""
+    return Counter(rejection.reason for rejection in rejections)
+
+
+def write_rejections(rejections, path=REJECTIONS_PATH):
+    """List rejected spectra as tab separated NIST ID, reason and detail lines."""
+    with open(path, 'w') as rejections_file:
+        for rejection in rejections:
+            detail = ' '.join(str(rejection.detail or '').split())
+            rejections_file.write('%s\t%s\t%s\n' % (rejection.nistid, rejection.reason, detail))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--manifest', default=MANIFEST_PATH, help='manifest of the jdx/ and mol/ files to preprocess')
+    parser.add_argument('--jdx', default='jdx', help='jdx directory, indexed if the manifest is empty')
+    parser.add_argument('--mol', default='mol', help='mol directory, indexed if the manifest is empty')
+    parser.add_argument('--pack-dir', help='preprocess a pack store instead of the jdx/ and mol/ files')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE, help='spectra handed to a worker at a time')
+    parser.add_argument('--output', default=DATASET_PATH, help='dataset directory to write')
+    parser.add_argument('--rejections', default=REJECTIONS_PATH, help='where to list rejected spectra with their reasons')
+    args = parser.parse_args()
+    if args.pack_dir:
+        store = PackStore(args.pack_dir)
+        tasks = artifact_tasks(pack_store=store)
+        store.close()
+    else:
+        manifest = ArtifactManifest(args.manifest)
+        if not len(manifest):
+            manifest.build(args.jdx, args.mol)
+        tasks = artifact_tasks(manifest)
+        manifest.close()
+    results, rejections = [], []
+    for result in tqdm(preprocess(tasks, args.processes, args.chunksize, args.pack_dir), total=len(tasks)):
+        if isinstance(result, Rejection):
+            rejections.append(result)
+        else:
+            results.append(result)
+    spectra = np.array([result.spectrum for result in results], dtype=np.float32).reshape(-1, len(GRID))
+    write_dataset(spectra, [result.smiles for result in results],
+                  [result.nistid for result in results], args.output)
+    write_rejections(rejections, args.rejections)
+    print('%d spectra written to %s, %d rejected: %s' % (len(results), args.output, len(rejections), dict(rejection_counts(rejections))))
+
+
+if __name__ == '__main__':
+    main()
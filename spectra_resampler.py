@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Vectorized resampling of JCAMP spectra onto the fixed wavenumber grid of the dataset.
+
+A batch of spectra is flattened into one array: unit conversions are applied to all points at once, descending segments are reversed with index arithmetic, and every segment is
+shifted into its own disjoint x range so a single np.interp call resamples the whole batch.
+"""
+import numpy as np
+
+# 450 to 4912 cm-1 in steps of 2: the 2232 columns of the dataset
+GRID = np.arange(450, 4914, 2)
+BATCH_SIZE = 1024
+# Absorbance is clipped to this range; negative values are non-physical
+ABSORBANCE_RANGE = (0.0, 5.0)
+
+
+def _field(spectrum, key, default):
+    value = spectrum.get(key, default)
+    return default if value is None else value
+
+
+def resample_batch(spectra, grid=GRID, fill=0.0):
+    """Resample jcamp spectrum dicts onto grid, returning a (len(spectra), len(grid)) float32 absorbance matrix.
+
+    x and y are taken as read by jcamp, which has already applied XFACTOR and YFACTOR. MICROMETERS
+    are converted to wavenumbers (1e4 / x) and TRANSMITTANCE to absorbance (-log10(y)). Spectra may
+    be ascending or descending in x. Grid points outside a spectrum's range are set to fill.
+    """
+    grid = np.asarray(grid, dtype=np.float64)
+    count = len(spectra)
+    if not count:
+        return np.zeros((0, len(grid)), dtype=np.float32)
+    lengths = np.array([len(spectrum['x']) for spectrum in spectra])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    x = np.concatenate([np.asarray(spectrum['x'], dtype=np.float64) for spectrum in spectra])
+    y = np.concatenate([np.asarray(spectrum['y'], dtype=np.float64) for spectrum in spectra])
+    micrometers = np.repeat(['MICROMETERS' in str(_field(spectrum, 'xunits', '')).upper() for spectrum in spectra], lengths)
+    x[micrometers] = 1e4 / x[micrometers]
+    transmittance = np.repeat(['TRANSMITTANCE' in str(_field(spectrum, 'yunits', '')).upper() for spectrum in spectra], lengths)
+    y[transmittance] = -np.log10(y[transmittance] + 1e-10)
+    y = np.clip(y, *ABSORBANCE_RANGE)
+
+    # Reverse descending segments so every segment is ascending
+    ends = starts + lengths - 1
+    descending = np.repeat(x[ends] < x[starts], lengths)
+    segment_starts = np.repeat(starts, lengths)
+    segment_ends = np.repeat(ends, lengths)
+    positions = np.arange(len(x))
+    order = np.where(descending, segment_ends - (positions - segment_starts), positions)
+    x, y = x[order], y[order]
+
+    # Shift each segment (and its grid) into its own x range, so one interpolation covers them all
+    low = np.minimum(x[starts], grid[0])
+    span = max(x.max(), grid[-1]) - min(x.min(), grid[0]) + 1.0
+    offsets = np.arange(count) * span
+    shifted_x = x - np.repeat(low, lengths) + np.repeat(offsets, lengths)
+    shifted_grid = (grid[None, :] - low[:, None] + offsets[:, None]).ravel()
+    resampled = np.interp(shifted_grid, shifted_x, y).reshape(count, len(grid))
+    inside = (grid[None, :] >= x[starts][:, None]) & (grid[None, :] <= x[ends][:, None])
+    return np.where(inside, resampled, fill).astype(np.float32)
+
+
+def resample_all(spectra, grid=GRID, batch_size=BATCH_SIZE, **kwargs):
+    """Resample any number of spectra in batches of batch_size, returning one float32 matrix."""
+    batches = [resample_batch(spectra[start:start + batch_size], grid, **kwargs) for start in range(0, len(spectra), batch_size)]
+    return np.vstack(batches) if batches else np.zeros((0, len(grid)), dtype=np.float32)
@@ -1,19 +1,44 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 """Supervised script to run the NIST Spectra Scraper with automatic restart on failure."""
+import argparse
 import os
+import re
 import sys
 import time
 import subprocess
-import signal
-import re
+import json
+import threading
 from datetime import datetime, timedelta
-from collections import deque
+from collections import Counter, deque
+
+from rotating_log import RotatingLog
+from scraper_events import EVENTS_FD_ENV, CONNECTION, HTTP, OTHER, THROTTLED, TIMEOUT
 
 # Configuration
 SCRAPER_SCRIPT = "1) NIST Spectra Scraper.py"
+SCRAPER_ARGS = []  # arguments the supervisor doesn't know, passed through to every scraper run
 LOG_FILE = "scraping_output.log"
-RESTART_DELAY = 60  # seconds to wait before restarting
+LOG_MAX_BYTES = 50 * 2 ** 20  # rotate the log at this size...
+LOG_MAX_AGE = None  # ...or after this many seconds
+LOG_BACKUPS = 5  # rotated logs to keep, gzip compressed
+# Which scraper output lines reach the console: 'all', 'progress' (no per-request or per-file lines) or 'quiet'
+CONSOLE_VERBOSITY = "progress"
+CHATTY_LINE_RE = re.compile(r"Already exists|^HTTP \d+ in |: Downloading|^Saving |^Searching: |^Result: ")
+RESTART_DELAY = 60  # seconds to wait before restarting after a crash
+# Seconds to wait before restarting a run whose jobs failed, by failure category - the longest one wins
+RESTART_DELAYS = {THROTTLED: 600, CONNECTION: 120, TIMEOUT: 60, HTTP: 60, OTHER: 10}
+# Where a crashed run's last output lines point to, for choosing the restart delay
+CRASH_PATTERNS = [
+    (THROTTLED, re.compile(r"Too many requests|\b429\b", re.IGNORECASE)),
+    (TIMEOUT, re.compile(r"Timeout|timed out", re.IGNORECASE)),
+    (CONNECTION, re.compile(r"ConnectionError|Connection (refused|reset)|SSLError|ChunkedEncodingError")),
+    (HTTP, re.compile(r"HTTPError")),
+]
+# Lines of a crashed run's output to search for CRASH_PATTERNS
+CRASH_CONTEXT_LINES = 50
+
+log = None  # RotatingLog, opened by main
 MAX_RESTARTS = 10000   # maximum number of restart attempts
 FAILURE_THRESHOLD = (20, 25) # (failures, minutes): if 20 failures in 25 minutes, stop script
 
@@ -23,73 +48,89 @@ def log_message(message):
     formatted_message = f"[{timestamp}] {message}"
     print(formatted_message)
     
-    with open(LOG_FILE, "a") as log:
-        log.write(formatted_message + "\n")
+    if log is not None:
+        log.write(formatted_message)
 
-def is_failure(log_content):
-    """Check if the log indicates a failure that requires restart."""
-    # Common failure patterns
-    failure_patterns = [
-        r"Connection refused",
-        r"Connection reset by peer",
-        r"timeout",
-        r"Too many requests",
-        r"rate limit",
-        r"HTTPError",
-        r"SSLError",
-        r"ConnectionError",
-        r"Max retries exceeded",
-        r"ChunkedEncodingError",
-        r"ReadTimeout",
-        r"ConnectTimeout"
-    ]
-    
-    for pattern in failure_patterns:
-        if re.search(pattern, log_content, re.IGNORECASE):
-            return True
-    
-    return False
+def crash_category(lines):
+    """Return the failure category the last lines of a crashed run point to, or None."""
+    for line in reversed(lines):
+        for category, pattern in CRASH_PATTERNS:
+            if pattern.search(line):
+                return category
+    return None
 
-def run_scraper():
-    """Run the NIST scraper script and return True if successful, False otherwise."""
+def read_events(stream, run):
+    """Classify the structured events of one scraper run as they arrive."""
+    for line in stream:
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue
+        if event['event'] == 'job-failed':
+            run['failures'][event['category']] += 1
+            run['failed_jobs'].append((event['kind'], event['key']))
+        elif event['event'] == 'phase-done':
+            log_message(f"Phase {event['kind']} done: {event['counts']}")
+        elif event['event'] == 'run-done':
+            run['completed'] = True
+
+def run_scraper(retry_failed=False):
+    """Run the NIST scraper script once and return a summary of the run.
+
+    The summary holds the return code, whether the scraper got to the end of its run, and how many
+    jobs failed in each failure category (see scraper_events). Failures are classified from the
+    scraper's structured events for this run only, not from the log.
+    """
+    run = {'return_code': None, 'completed': False, 'failures': Counter(), 'failed_jobs': [], 'crash': None}
+    args = [sys.executable, SCRAPER_SCRIPT] + SCRAPER_ARGS
+    if retry_failed:
+        args.append('--retry-failed')
+    lines = 0
+    read_fd, write_fd = os.pipe()
     try:
-        # Run the scraper script and redirect output to the log file
+        # Run the scraper script, passing it the write end of the event pipe
         process = subprocess.Popen(
-            [sys.executable, SCRAPER_SCRIPT],
+            args,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
             text=True,
             bufsize=1,
-            universal_newlines=True
+            universal_newlines=True,
+            pass_fds=(write_fd,),
+            env=dict(os.environ, **{EVENTS_FD_ENV: str(write_fd)})
         )
+        os.close(write_fd)
+        write_fd = None
+        events = threading.Thread(target=read_events, args=(os.fdopen(read_fd), run), daemon=True)
+        read_fd = None
+        events.start()
         
-        # Stream output to both console and log file
-        with open(LOG_FILE, "a") as log:
-            while True:
-                line = process.stdout.readline()
-                if not line and process.poll() is not None:
-                    break
-                if line:
-                    print(line.strip())
-                    log.write(line)
-        
-        # Check if the process completed successfully
-        return_code = process.poll()
+        # Stream output to the log file, and as much of it as CONSOLE_VERBOSITY asks for to the console
+        for line in process.stdout:
+            line = line.rstrip("\n")
+            lines += 1
+            log.write(line)
+            if CONSOLE_VERBOSITY == "all" or (CONSOLE_VERBOSITY == "progress" and not CHATTY_LINE_RE.search(line)):
+                print(line)
         
-        # Read the log file to check for failure patterns
-        with open(LOG_FILE, "r") as log:
-            log_content = log.read()
-        
-        if return_code != 0 or is_failure(log_content):
-            log_message(f"Scraper failed with return code {return_code}")
-            return False
-        
-        log_message("Scraper completed successfully")
-        return True
-    
+        run['return_code'] = process.wait()
+        events.join()
     except Exception as e:
         log_message(f"Error running scraper: {str(e)}")
-        return False
+    finally:
+        for fd in (read_fd, write_fd):
+            if fd is not None:
+                os.close(fd)
+    
+    if not run['completed']:
+        recent = list(log.recent)[-min(lines, CRASH_CONTEXT_LINES):] if lines else []
+        run['crash'] = crash_category(recent)
+        log_message(f"Scraper crashed with return code {run['return_code']} ({run['crash'] or 'unknown cause'})")
+    elif run['failures']:
+        log_message(f"Scraper finished with {len(run['failed_jobs'])} failed jobs: {dict(run['failures'])}")
+    else:
+        log_message("Scraper completed successfully")
+    return run
 
 def check_failure_threshold(failure_timestamps):
     """Check if the failure threshold has been exceeded."""
@@ -116,21 +157,54 @@ def check_failure_threshold(failure_timestamps):
     
     return False
 
+def restart_delay(run):
+    """Return how long to wait before restarting after a run, scaled by how its jobs failed."""
+    if run['crash'] is not None:
+        return RESTART_DELAYS[run['crash']]
+    return max([RESTART_DELAYS[category] for category in run['failures']] or [RESTART_DELAY])
+
 def main():
     """Main function to supervise the scraper with automatic restart on failure."""
+    global log, SCRAPER_ARGS, CONSOLE_VERBOSITY
+    parser = argparse.ArgumentParser(description=__doc__, epilog="Other arguments are passed through to the scraper.")
+    parser.add_argument("--console", choices=("all", "progress", "quiet"), default=CONSOLE_VERBOSITY,
+                        help="which scraper output lines to print")
+    parser.add_argument("--log-max-bytes", type=int, default=LOG_MAX_BYTES, help="rotate the log at this size")
+    parser.add_argument("--log-max-age", type=float, default=LOG_MAX_AGE, help="rotate the log after this many seconds")
+    parser.add_argument("--log-backups", type=int, default=LOG_BACKUPS, help="rotated logs to keep")
+    parser.add_argument("--no-compress", action="store_true", help="don't gzip rotated logs")
+    args, SCRAPER_ARGS = parser.parse_known_args()
+    CONSOLE_VERBOSITY = args.console
+    # In resident mode the scraper retries failed jobs itself, so it is only relaunched after a crash
+    resident = "--resident" in SCRAPER_ARGS
+    
+    log = RotatingLog(LOG_FILE, max_bytes=args.log_max_bytes, max_age=args.log_max_age,
+                      backups=args.log_backups, compress=not args.no_compress)
+    try:
+        return supervise(resident)
+    finally:
+        log.close()
+
+def supervise(resident):
+    """Run the scraper until it succeeds, restarting it after failures."""
     restart_count = 0
     failure_timestamps = deque(maxlen=1000)  # Store timestamps of recent failures
     
-    # Create or clear the log file
-    with open(LOG_FILE, "w") as log:
-        log.write(f"Starting supervised scraper at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-    
     log_message("Starting supervised scraper")
     
+    retry_failed = False
     while restart_count < MAX_RESTARTS:
-        if run_scraper():
+        run = run_scraper(retry_failed)
+        if run['completed'] and run['return_code'] == 0:
             log_message("Scraper completed successfully, exiting")
             return 0
+        if run['completed'] and resident:
+            log_message(f"Resident scraper gave up on {len(run['failed_jobs'])} jobs, exiting")
+            return 1
+        
+        # A run that got to the end only needs its failed jobs rerun; after a crash the
+        # scraper resumes from its ledger
+        retry_failed = run['completed']
         
         # Record the failure timestamp
         failure_timestamps.append(datetime.now())
@@ -141,10 +215,11 @@ def main():
             return 1
         
         restart_count += 1
-        log_message(f"Scraper failed, restarting in {RESTART_DELAY} seconds (attempt {restart_count}/{MAX_RESTARTS})")
+        delay = restart_delay(run)
+        log_message(f"Scraper failed, restarting{' its failed jobs' if retry_failed else ''} in {delay} seconds (attempt {restart_count}/{MAX_RESTARTS})")
         
         # Wait before restarting
-        time.sleep(RESTART_DELAY)
+        time.sleep(delay)
     
     log_message(f"Maximum restart attempts ({MAX_RESTARTS}) reached, giving up")
     return 1
@@ -0,0 +1,32 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+jcamp = pytest.importorskip('jcamp')
+
+from spectra_resampler import resample_batch
+
+JDX = """##TITLE=test
+##JCAMP-DX=4.24
+##DATA TYPE=INFRARED SPECTRUM
+##XUNITS=1/CM
+##YUNITS=ABSORBANCE
+##XFACTOR=1
+##YFACTOR=0.001
+##FIRSTX=1000
+##LASTX=1006
+##NPOINTS=4
+##FIRSTY=0.5
+##XYDATA=(X++(Y..Y))
+1000 500 500 500 500
+##END=
+"""
+
+
+def test_resample_jcamp_read_applies_yfactor_once(tmp_path):
+    path = tmp_path / 'test-IR.jdx'
+    path.write_text(JDX)
+    spectrum = jcamp.jcamp_readfile(str(path))
+    assert spectrum['yfactor'] != 1
+    resampled = resample_batch([spectrum], grid=np.arange(996, 1010, 2))
+    assert resampled.shape == (1, 7)
+    np.testing.assert_allclose(resampled[0], [0, 0, 0.5, 0.5, 0.5, 0.5, 0], rtol=1e-6)